@@ -5,6 +5,7 @@ from constellation.constellation import (
     ConstellationService,
     ConstellationVolumeMount,
 )
+from constellation.ready import ExecProbe, HttpProbe, TcpProbe
 from constellation.util import BuildSpec, ImageReference
 
 __all__ = [
@@ -14,5 +15,8 @@ __all__ = [
     "ConstellationContainer",
     "ConstellationService",
     "ConstellationVolumeMount",
+    "ExecProbe",
+    "HttpProbe",
     "ImageReference",
+    "TcpProbe",
 ]
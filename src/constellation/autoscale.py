@@ -0,0 +1,131 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import docker
+
+from constellation import docker_util, stats
+from constellation.util import run_parallel
+
+
+@dataclass
+class AutoscalePolicy:
+    # Bounds on the number of replicas
+    min_replicas: int
+    max_replicas: int
+    # Mean cpu use per replica (percent of one cpu) above which we
+    # add replicas and below which we remove them
+    cpu_high: float = 80.0
+    cpu_low: float = 20.0
+    # Optional mean memory use per replica, as percent of its limit
+    memory_high: Optional[float] = None
+    memory_low: Optional[float] = None
+    # Seconds between samples, and number of samples to average over
+    interval: float = 10.0
+    window: int = 6
+    # Minimum seconds after any change before scaling up or down
+    cooldown_up: float = 60.0
+    cooldown_down: float = 300.0
+    # Number of replicas to add or remove at once
+    step: int = 1
+
+
+class Autoscaler:
+    """Scale a service between bounds based on its resource use.
+
+    Samples the cpu and memory use of each replica of the service
+    from the docker stats API, averages over the last `window`
+    samples, and calls Constellation.scale when the average crosses
+    the policy's thresholds (subject to cooldowns).  Call run() from a
+    long-lived process to keep doing this until `stop` is set.
+    """
+
+    def __init__(self, constellation, name, policy, parallel=4):
+        self.constellation = constellation
+        self.service = constellation.service(name)
+        self.policy = policy
+        self.parallel = parallel
+        self.samples = deque(maxlen=policy.window)
+        self.last_change = None
+
+    def sample(self):
+        """Mean cpu and memory percent over the service's replicas."""
+        replicas = self._replicas()
+        if not replicas:
+            return None
+
+        def sample_one(x):
+            try:
+                s = x.stats(stream=False)
+            except docker.errors.APIError:
+                # Replicas come and go during scaling and updates
+                return None
+            return stats.cpu_percent(s), stats.memory_percent(s)
+
+        res = run_parallel(sample_one, replicas, self.parallel)
+        res = [x for x in res if x is not None]
+        if not res:
+            return None
+        cpu = sum(x[0] for x in res) / len(res)
+        memory = sum(x[1] for x in res) / len(res)
+        return cpu, memory
+
+    def _replicas(self):
+        # As for Constellation's own methods, use its client if it has
+        # one, rather than the default daemon.
+        with docker_util.using_client(self.constellation.client):
+            return self.service.get(self.constellation.prefix)
+
+    def decide(self, current, now):
+        """The number of replicas we want, given samples so far."""
+        p = self.policy
+        target = min(max(current, p.min_replicas), p.max_replicas)
+        if target != current or len(self.samples) < p.window:
+            return target
+        cpu = sum(x[0] for x in self.samples) / len(self.samples)
+        memory = sum(x[1] for x in self.samples) / len(self.samples)
+        since = None if self.last_change is None else now - self.last_change
+
+        high = cpu > p.cpu_high or (
+            p.memory_high is not None and memory > p.memory_high
+        )
+        low = cpu < p.cpu_low and (
+            p.memory_low is None or memory < p.memory_low
+        )
+        if high and (since is None or since >= p.cooldown_up):
+            return min(current + p.step, p.max_replicas)
+        if low and (since is None or since >= p.cooldown_down):
+            return max(current - p.step, p.min_replicas)
+        return current
+
+    def step(self, now=None):
+        now = time.monotonic() if now is None else now
+        sample = self.sample()
+        if sample is not None:
+            self.samples.append(sample)
+        current = len(self._replicas())
+        target = self.decide(current, now)
+        if target != current:
+            cpu, memory = sample or (0, 0)
+            print(
+                f"Autoscaling '{self.service.name}' from {current} to "
+                f"{target} (cpu {cpu:.0f}%, memory {memory:.0f}%)"
+            )
+            self.constellation.scale(self.service.name, target)
+            self.last_change = now
+            # Load is spread over a different number of replicas now
+            self.samples.clear()
+        return target
+
+    def run(self, stop=None):
+        while stop is None or not stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                # Keep supervising; the next step may well succeed
+                print(f"Autoscaling '{self.service.name}' failed: {e}")
+            if stop is None:
+                time.sleep(self.policy.interval)
+            else:
+                stop.wait(self.policy.interval)
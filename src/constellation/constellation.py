@@ -1,11 +1,40 @@
+import contextlib
+import functools
+import time
 from abc import abstractmethod
 from pathlib import Path
 from typing import Optional, Union
 
 import docker
 
-from constellation import docker_util, vault
-from constellation.util import BuildSpec, ImageReference, rand_str, tabulate
+from constellation import docker_util, ready, vault
+from constellation.inventory import Inventory
+from constellation.logs import LogFollower
+from constellation.stats import StatsCollector
+from constellation.util import (
+    LABEL_PREFIX,
+    LABEL_REPLICA,
+    LABEL_ROLE,
+    LABEL_SPEC,
+    BuildSpec,
+    ImageReference,
+    constellation_labels,
+    dependency_waves,
+    rand_str,
+    run_graph,
+    run_parallel,
+    spec_hash,
+    tabulate,
+)
+
+
+def _using_own_client(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with docker_util.using_client(self.client):
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class Constellation:
@@ -19,8 +48,15 @@ class Constellation:
         data=None,
         vault_config=None,
         acme_buddy=None,
+        client=None,
+        build_log=None,
     ):
         self.data = data
+        # If None, use the process-wide docker client
+        self.client = client
+        # Called with (name, line) for each line of output while
+        # building images; see docker_util.image_build
+        self.build_log = build_log
 
         assert isinstance(name, str)
         self.name = name
@@ -39,10 +75,32 @@ class Constellation:
         self.vault_config = vault_config
         self.acme_buddy = acme_buddy
 
+    def _labels(self, role):
+        return constellation_labels(self.prefix, role, self.name)
+
+    def inventory(self):
+        return Inventory(
+            self.prefix,
+            [self.network.name],
+            [v.name for v in self.volumes.collection],
+            [
+                x.name_external(self.prefix)
+                for x in self.containers.collection
+                if isinstance(x, ConstellationContainer)
+            ],
+            [
+                x.replica_prefix(self.prefix)
+                for x in self.containers.collection
+                if isinstance(x, ConstellationService)
+            ],
+        )
+
+    @_using_own_client
     def status(self):
+        inventory = self.inventory()
         nw_name = self.network.name
         nw_status = (
-            "created" if docker_util.network_exists(nw_name) else "missing"
+            "created" if inventory.network_exists(nw_name) else "missing"
         )
         print(f"Constellation {self.name}")
         print("  * Network:")
@@ -50,41 +108,248 @@ class Constellation:
         print("  * Volumes:")
         for v in self.volumes.collection:
             v_status = (
-                "created" if docker_util.volume_exists(v.name) else "missing"
+                "created" if inventory.volume_exists(v.name) else "missing"
             )
             print(f"    - {v.role} ({v.name}): {v_status}")
         print("  * Containers:")
         for x in self.containers.collection:
             x_name = x.name_external(self.prefix)
-            x_status = x.status(self.prefix)
+            x_status = x.status(self.prefix, inventory)
             print(f"    - {x.name} ({x_name}): {x_status}")
 
-    def start(self, pull_images=False, subset=None):
-        if subset is None and any(self.containers.exists(self.prefix)):
+    @_using_own_client
+    def start(
+        self, pull_images=False, subset=None, parallel=1, wait_ready=False
+    ):
+        exists = self.containers.exists(self.prefix, self.inventory())
+        if subset is None and any(exists):
             msg = "Some containers exist"
             raise Exception(msg)
         if self.vault_config:
             vault.resolve_secrets(self.data, self.vault_config.client())
-        self.containers.prepare_images(pull=pull_images)
-        self.network.create()
-        self.volumes.create()
+        self.containers.prepare_images(
+            pull=pull_images, parallel=parallel, log=self.build_log
+        )
+        self.network.create(self._labels("network"))
+        self.volumes.create(self._labels("volume"))
         self.containers.start(
-            self.prefix, self.network, self.volumes, self.data, subset
+            self.prefix,
+            self.network,
+            self.volumes,
+            self.data,
+            subset,
+            parallel=parallel,
+            constellation=self.name,
+            wait_ready=wait_ready,
+        )
+
+    @_using_own_client
+    def apply(self, pull_images=False, parallel=1, wait_ready=False):
+        """Bring the running constellation into line with its definition.
+
+        Containers that are missing, not running, or whose definition
+        has changed since they were created are (re)created; all
+        others are left running.  Changes are detected with a hash of
+        each container's image id, arguments, environment, mounts,
+        ports, labels and so on, stored as a label when it is created.
+        Changes to configure hooks, or to the data passed to them,
+        are not detected.  Returns the names of the containers that
+        were (re)created.
+        """
+        if self.vault_config:
+            vault.resolve_secrets(self.data, self.vault_config.client())
+        self.containers.prepare_images(
+            pull=pull_images, parallel=parallel, log=self.build_log
+        )
+        self.network.create(self._labels("network"))
+        self.volumes.create(self._labels("volume"))
+        inventory = self.inventory()
+        changed = []
+        for x in self.containers.collection:
+            if x.up_to_date(
+                self.prefix, self.network, self.volumes, self.name, inventory
+            ):
+                print(f"'{x.name}' is up to date")
+            else:
+                changed.append(x.name)
+        if changed:
+            self.containers.stop(self.prefix, parallel=parallel, subset=changed)
+            self.containers.remove(
+                self.prefix, parallel=parallel, subset=changed
+            )
+            self.containers.start(
+                self.prefix,
+                self.network,
+                self.volumes,
+                self.data,
+                changed,
+                parallel=parallel,
+                constellation=self.name,
+                wait_ready=wait_ready,
+            )
+        return changed
+
+    @_using_own_client
+    def rolling_update(
+        self,
+        name,
+        pull_images=False,
+        batch_size=1,
+        max_unavailable=0,
+        timeout=None,
+    ):
+        """Update the replicas of one service without stopping it.
+
+        See ConstellationService.rolling_update.
+        """
+        service = self.service(name)
+        if self.vault_config:
+            vault.resolve_secrets(self.data, self.vault_config.client())
+        service.prepare_image(pull=pull_images, log=self.build_log)
+        service.rolling_update(
+            self.prefix,
+            self.network,
+            self.volumes,
+            self.data,
+            self.name,
+            batch_size=batch_size,
+            max_unavailable=max_unavailable,
+            timeout=timeout,
+        )
+
+    @_using_own_client
+    def scale(self, name, n, wait_ready=False, timeout=None, parallel=1):
+        """Change the number of replicas of a running service.
+
+        See ConstellationService.scale_to.
+        """
+        service = self.service(name)
+        if self.vault_config:
+            vault.resolve_secrets(self.data, self.vault_config.client())
+        if service.image_id is None:
+            service.prepare_image(pull=False, log=self.build_log)
+        service.scale_to(
+            n,
+            self.prefix,
+            self.network,
+            self.volumes,
+            self.data,
+            self.name,
+            wait_ready=wait_ready,
+            timeout=timeout,
+            parallel=parallel,
+        )
+
+    @_using_own_client
+    def stats(self, duration=5, containers=None, history=120):
+        """Collect resource use from all running containers.
+
+        Samples are collected from every container (and service
+        replica) at once for `duration` seconds, and summarised as
+        the median, 95th percentile and maximum of each metric (see
+        stats.summarise).  Restrict to some containers by passing
+        their names as `containers`.
+        """
+        running = self.containers.running(self.prefix, containers)
+        with StatsCollector(running, history) as collector:
+            time.sleep(duration)
+        return collector.summary()
+
+    @_using_own_client
+    def stats_stream(self, containers=None, history=120):
+        """Yield (name, metrics) as samples arrive from all containers.
+
+        Stops collecting when the generator is closed.
+        """
+        running = self.containers.running(self.prefix, containers)
+        return StatsCollector(running, history).stream()
+
+    @_using_own_client
+    def logs(self, follow=True, since=None, containers=None, queue_size=1000):
+        """Yield log lines from all running containers as they arrive.
+
+        Each LogLine carries the container (or replica) name and the
+        docker timestamp along with the text, and prints as
+        `name | timestamp text`.  Lines are read through a queue of at
+        most `queue_size` lines, so memory use stays bounded however
+        much the containers log.  Restrict to some containers by
+        passing their names as `containers`, and to recent logs with
+        `since` (a datetime or unix timestamp).  Without `follow` the
+        generator ends once existing logs have been read.
+        """
+        running = self.containers.running(self.prefix, containers)
+        return LogFollower(running, follow, since, queue_size).lines()
+
+    @_using_own_client
+    def exec_all(
+        self,
+        args,
+        containers=None,
+        parallel=4,
+        timeout=None,
+        check=True,
+        **kwargs,
+    ):
+        """Run a command in all running containers at once.
+
+        Restrict to some containers (e.g., a service, covering all of
+        its replicas) by passing their names as `containers`.  See
+        docker_util.exec_all for the other arguments; returns a dict
+        of ExecReport by container (or replica) name.
+        """
+        running = self.containers.running(self.prefix, containers)
+        return docker_util.exec_all(
+            running, args, parallel, timeout, check=check, **kwargs
         )
 
-    def stop(self, kill=False, remove_network=False, remove_volumes=False):
-        self.containers.stop(self.prefix, kill)
-        self.containers.remove(self.prefix)
+    def service(self, name):
+        service = self.containers.find(name)
+        if not isinstance(service, ConstellationService):
+            msg = f"'{name}' is not a service"
+            raise Exception(msg)
+        return service
+
+    @_using_own_client
+    def stop(
+        self,
+        kill=False,
+        remove_network=False,
+        remove_volumes=False,
+        *,
+        parallel=1,
+        timeout=None,
+        deadline=None,
+    ):
+        """Stop and remove all containers.
+
+        Containers are stopped in reverse dependency order, with up to
+        `parallel` containers stopped at once. Each container is given
+        `timeout` seconds (the docker default if None) to stop
+        gracefully. If `deadline` is given, any container still to be
+        stopped that many seconds after we started is killed instead.
+        """
+        self.containers.stop(
+            self.prefix,
+            kill,
+            parallel=parallel,
+            timeout=timeout,
+            deadline=deadline,
+        )
+        self.containers.remove(self.prefix, parallel=parallel)
         if remove_network:
             self.network.remove()
         if remove_volumes:
             self.volumes.remove()
 
-    def restart(self, pull_images=True):
-        self.containers.prepare_images(pull=pull_images)
+    @_using_own_client
+    def restart(self, pull_images=True, parallel=1):
+        self.containers.prepare_images(
+            pull=pull_images, parallel=parallel, log=self.build_log
+        )
         self.stop()
-        self.start()
+        self.start(parallel=parallel)
 
+    @_using_own_client
     def destroy(self):
         self.stop(True, True, True)
 
@@ -111,6 +376,22 @@ class ConstellationContainer:
 
     which will expose port 80 (same port on both the container and
     host) and expose port 2222 in the container as 3333 on the host.
+
+    To control start order, pass the names of other containers in the
+    constellation as depends_on; this container will only be started
+    once all of those have been started.
+
+    Every container is labelled with the constellation's prefix (and
+    name, if known) and its role, in addition to any labels given.
+
+    A docker healthcheck can be given as a dict (see the docker-py
+    documentation for create_container), and a readiness probe as
+    ready (one of TcpProbe, HttpProbe or ExecProbe, or any callable
+    taking the container and its address).  When starting with
+    wait_ready=True we wait, for up to ready_timeout seconds, for the
+    probe to pass (or, without a probe, for the healthcheck to report
+    healthy) before running configure, and containers that depend on
+    this one are started as soon as it is ready.
     """
 
     def __init__(
@@ -127,6 +408,10 @@ class ConstellationContainer:
         labels=None,
         preconfigure=None,
         network="none",
+        depends_on=None,
+        healthcheck=None,
+        ready=None,
+        ready_timeout=60,
     ):
         self.name = name
         self.image = image
@@ -141,28 +426,68 @@ class ConstellationContainer:
         self.labels = labels
         self.preconfigure = preconfigure
         self.network = network
+        self.depends_on = list(depends_on or [])
+        self.healthcheck = healthcheck
+        self.ready = ready
+        self.ready_timeout = ready_timeout
         self.image_id = None
 
     def name_external(self, prefix):
         return f"{prefix}-{self.name}"
 
-    def prepare_image(self, *, pull: bool):
-        if isinstance(self.image, BuildSpec):
-            self.image_id = docker_util.image_build(self.name, self.image)
-        elif pull:
-            docker_util.image_pull(self.name, str(self.image))
-            self.image_id = str(self.image)
-        else:
-            docker_util.ensure_image(self.name, str(self.image))
-            self.image_id = str(self.image)
+    def prepare_image(self, *, pull: bool, log=None):
+        self.image_id = prepare_image(self.name, self.image, pull=pull, log=log)
+
+    def exists(self, prefix, inventory=None):
+        name = self.name_external(prefix)
+        if inventory:
+            return inventory.container_exists(name)
+        return docker_util.container_exists(name)
+
+    def _labels(self, prefix, constellation):
+        return {
+            **constellation_labels(prefix, self.name, constellation),
+            **(self.labels or {}),
+        }
+
+    def spec_hash(self, prefix, network, volumes, constellation=None):
+        labels = self._labels(prefix, constellation)
+        # Replicas of a service share a definition
+        labels.pop(LABEL_REPLICA, None)
+        spec = {
+            "image": docker_util.image_id(self.image_id),
+            "args": self.args,
+            "mounts": [x.to_mount(volumes) for x in self.mounts],
+            # Port keys may mix ints (80) and strings ("53/udp"),
+            # which cannot be sorted
+            "ports": self.ports_config
+            and {str(k): v for k, v in self.ports_config.items()},
+            "environment": self.environment,
+            "entrypoint": self.entrypoint,
+            "working_dir": self.working_dir,
+            "labels": labels,
+            "network": network.name,
+            "healthcheck": self.healthcheck,
+        }
+        return spec_hash(spec)
+
+    def up_to_date(self, prefix, network, volumes, constellation, inventory):
+        container = self.get(prefix, inventory)
+        return (
+            container is not None
+            and container.status == "running"
+            and container.labels.get(LABEL_SPEC)
+            == self.spec_hash(prefix, network, volumes, constellation)
+        )
 
-    def exists(self, prefix):
-        return docker_util.container_exists(self.name_external(prefix))
+    def create_template(self, prefix, network, volumes, constellation=None):
+        """Arguments to create_container for this definition.
 
-    def start(self, prefix, network, volumes, data=None):
-        cl = docker.client.from_env()
-        nm = self.name_external(prefix)
-        print(f"Starting {self.name} ({self.image_id})")
+        This covers everything except the container's name and
+        networking, so can be computed once and shared by all the
+        replicas of a service.
+        """
+        cl = docker_util.get_client()
         mounts = [x.to_mount(volumes) for x in self.mounts]
 
         if self.ports_config:
@@ -173,54 +498,103 @@ class ConstellationContainer:
         else:
             host_config = cl.api.create_host_config(mounts=mounts)
 
-        endpoint_config = cl.api.create_endpoint_config(aliases=[self.name])
+        labels = self._labels(prefix, constellation)
+        labels[LABEL_SPEC] = self.spec_hash(
+            prefix, network, volumes, constellation
+        )
+        return {
+            "image": self.image_id,
+            "command": self.args,
+            "detach": True,
+            "labels": labels,
+            "ports": self.container_ports,
+            "environment": self.environment,
+            "entrypoint": self.entrypoint,
+            "working_dir": self.working_dir,
+            "healthcheck": self.healthcheck,
+            "host_config": host_config,
+        }
+
+    def start(
+        self,
+        prefix,
+        network,
+        volumes,
+        data=None,
+        constellation=None,
+        wait_ready=False,
+        _parallel=1,
+    ):
+        print(f"Starting {self.name} ({self.image_id})")
+        template = self.create_template(prefix, network, volumes, constellation)
+        self._launch(
+            template,
+            self.name_external(prefix),
+            self.name,
+            network,
+            data,
+            wait_ready,
+        )
+
+    def _launch(
+        self, template, name, alias, network, data, wait_ready, labels=None
+    ):
+        cl = docker_util.get_client()
+        endpoint_config = cl.api.create_endpoint_config(aliases=[alias])
         networking_config = cl.api.create_networking_config(
             {f"{network.name}": endpoint_config}
         )
+        if labels:
+            template = {**template, "labels": {**template["labels"], **labels}}
         x_obj = cl.api.create_container(
-            self.image_id,
-            self.args,
-            name=nm,
-            detach=True,
-            labels=self.labels,
-            ports=self.container_ports,
-            environment=self.environment,
-            entrypoint=self.entrypoint,
-            working_dir=self.working_dir,
-            host_config=host_config,
-            networking_config=networking_config,
+            name=name, networking_config=networking_config, **template
         )
         container_id = x_obj["Id"]
         x = cl.containers.get(container_id)
+        docker_util.mark_changed()
 
         if self.preconfigure:
             self.preconfigure(x, data)
 
         x.start()
 
+        if wait_ready:
+            ready.wait_ready(x, self.ready, network.name, self.ready_timeout)
+
         if self.configure:
             self.configure(x, data)
 
-    def get(self, prefix):
-        client = docker.client.from_env()
+    def get(self, prefix, inventory=None):
+        if inventory:
+            return inventory.get_container(self.name_external(prefix))
+        client = docker_util.get_client()
         try:
             return client.containers.get(self.name_external(prefix))
         except docker.errors.NotFound:
             return None
 
-    def status(self, prefix):
-        container = self.get(prefix)
+    def status(self, prefix, inventory=None):
+        container = self.get(prefix, inventory)
         return container.status if container else "missing"
 
-    def stop(self, prefix, kill=False):
-        docker_util.container_stop(self.get(prefix), kill, self.name)
+    def running(self, prefix):
+        container = self.get(prefix)
+        if container and container.status == "running":
+            return {self.name: container}
+        return {}
 
-    def remove(self, prefix):
+    def stop(self, prefix, kill=False, timeout=None, until=None, _parallel=1):
+        docker_util.container_stop(
+            self.get(prefix), kill, self.name, timeout, until
+        )
+
+    def remove(self, prefix, _parallel=1):
         container = self.get(prefix)
         if container:
             print(f"Removing '{self.name}'")
             with docker_util.ignoring_missing():
                 container.remove()
+            docker_util.mark_changed()
 
 
 # This could be achieved by inheriting from ConstellationContainer but
@@ -234,51 +608,295 @@ class ConstellationService:
         self.scale = scale
         self.kwargs = kwargs
         self.base = ConstellationContainer(name, image, **kwargs)
+        self.depends_on = self.base.depends_on
 
+    # Replicas are named with an index from 1 to scale
     def name_external(self, prefix):
         return f"{self.base.name_external(prefix)}-<i>"
 
-    def prepare_image(self, *, pull: bool):
-        return self.base.prepare_image(pull=pull)
-
-    def exists(self, prefix):
-        return bool(self.get(prefix))
+    # Before replicas were labelled they had random names; those are
+    # found (and replaced) by this prefix.
+    def replica_prefix(self, prefix):
+        return f"{self.base.name_external(prefix)}-"
+
+    @property
+    def image_id(self):
+        return self.base.image_id
+
+    @image_id.setter
+    def image_id(self, value):
+        self.base.image_id = value
+
+    def prepare_image(self, *, pull: bool, log=None):
+        return self.base.prepare_image(pull=pull, log=log)
+
+    # Stopped replicas still hold their names, so count them too
+    def exists(self, prefix, inventory=None):
+        return bool(self.get(prefix, True, inventory))
+
+    # The number of replicas may have been changed in place (see
+    # scale_to), possibly by another process, so is not compared
+    # with our scale.
+    def up_to_date(self, prefix, network, volumes, constellation, inventory):
+        containers = self.get(prefix, True, inventory)
+        if not containers:
+            return False
+        expected = self.base.spec_hash(prefix, network, volumes, constellation)
+        return all(
+            x.status == "running" and x.labels.get(LABEL_SPEC) == expected
+            for x in containers
+        )
 
-    def start(self, prefix, network, volumes, data=None):
+    def start(
+        self,
+        prefix,
+        network,
+        volumes,
+        data=None,
+        constellation=None,
+        wait_ready=False,
+        parallel=1,
+    ):
         print(f"Starting *service* {self.name}")
-        for _i in range(self.scale):
-            name = f"{self.name}-{rand_str(8)}"
-            container = ConstellationContainer(name, self.image, **self.kwargs)
-            container.image_id = self.base.image_id
-            container.start(prefix, network, volumes, data)
-
-    def get(self, prefix, stopped=False):
-        pattern = self.base.name_external(prefix) + "-"
-        return docker_util.containers_matching(pattern, stopped)
-
-    def status(self, prefix):
-        status = tabulate([x.status for x in self.get(prefix)])
+        self._start_replicas(
+            range(1, self.scale + 1),
+            prefix,
+            network,
+            volumes,
+            data,
+            constellation,
+            wait_ready,
+            parallel,
+        )
+
+    def _start_replicas(
+        self,
+        indices,
+        prefix,
+        network,
+        volumes,
+        data,
+        constellation,
+        wait_ready,
+        parallel=1,
+    ):
+        # Replicas differ only in their name, network alias and
+        # replica label, so the rest is computed once for them all.
+        # They are labelled with the service's role, not their own
+        # name, so that they can be found together.
+        template = self.base.create_template(
+            prefix, network, volumes, constellation
+        )
+
+        def start_one(i):
+            name = f"{self.name}-{i}"
+            print(f"Starting {name} ({self.image_id})")
+            self.base._launch(
+                template,
+                f"{prefix}-{name}",
+                name,
+                network,
+                data,
+                wait_ready,
+                {LABEL_REPLICA: str(i)},
+            )
+
+        run_parallel(start_one, indices, parallel)
+
+    def rolling_update(
+        self,
+        prefix,
+        network,
+        volumes,
+        data=None,
+        constellation=None,
+        batch_size=1,
+        max_unavailable=0,
+        timeout=None,
+    ):
+        """Replace the replicas of a running service a batch at a time.
+
+        Every replica index that exists is replaced, so a service that
+        has been scaled in place keeps its current number of replicas
+        (if there are none, `scale` replicas are started, or as many
+        as there are replicas from before they were indexed; those are
+        retired at the end).  For each
+        batch of `batch_size` replica indices, up to
+        `max_unavailable` old replicas are retired first, then the
+        others are renamed out of the way so that new replicas can be
+        started with the same names.  Once the new replicas are ready
+        (see ConstellationContainer), the rest of the batch's old
+        replicas are retired (each given `timeout` seconds to stop).
+        With the default max_unavailable of 0 the service never runs
+        with fewer than its current replicas.  If a batch fails to
+        start, its new replicas are removed and its old replicas
+        (other than any already retired) restored before the error
+        is raised.
+        """
+        if batch_size < 1:
+            msg = "batch_size must be at least 1"
+            raise Exception(msg)
+        print(f"Updating *service* {self.name}")
+        old, unindexed = self._replicas(prefix)
+        n = len(unindexed) or self.scale
+        indices = sorted(old) or list(range(1, n + 1))
+
+        while indices:
+            batch, indices = indices[:batch_size], indices[batch_size:]
+            batch_old = [old.pop(i) for i in batch if i in old]
+            early = batch_old[:max_unavailable]
+            for x in early:
+                self._retire(x, timeout)
+            kept = [(x, x.name) for x in batch_old[len(early) :]]
+            for x, name in kept:
+                x.rename(f"{name}-{rand_str(8)}")
+            try:
+                self._start_replicas(
+                    batch,
+                    prefix,
+                    network,
+                    volumes,
+                    data,
+                    constellation,
+                    True,
+                    len(batch),
+                )
+            except Exception:
+                self._roll_back(prefix, batch, kept)
+                raise
+            for x, _name in kept:
+                self._retire(x, timeout)
+
+        for x in unindexed:
+            self._retire(x, timeout)
+
+    def scale_to(
+        self,
+        n,
+        prefix,
+        network,
+        volumes,
+        data=None,
+        constellation=None,
+        wait_ready=False,
+        timeout=None,
+        parallel=1,
+    ):
+        """Add or remove replicas of a running service to reach `n`.
+
+        Replicas that have stopped are removed, missing indices up to
+        `n` are started and replicas with higher indices are retired,
+        highest first.  Replicas that are running and below `n` are
+        left alone; any from before replicas were indexed are retired
+        once the new ones have started.
+        """
+        replicas, unindexed = self._replicas(prefix)
+        for i, x in list(replicas.items()):
+            if x.status != "running":
+                self._retire(x, timeout)
+                del replicas[i]
+        print(f"Scaling *service* {self.name} from {len(replicas)} to {n}")
+        for i in sorted(replicas, reverse=True):
+            if i > n:
+                self._retire(replicas[i], timeout)
+        missing = [i for i in range(1, n + 1) if i not in replicas]
+        if missing:
+            self._start_replicas(
+                missing,
+                prefix,
+                network,
+                volumes,
+                data,
+                constellation,
+                wait_ready,
+                parallel,
+            )
+        for x in unindexed:
+            self._retire(x, timeout)
+        self.scale = n
+
+    # Replicas by index, and any without one
+    def _replicas(self, prefix):
+        indexed = {}
+        unindexed = []
+        for x in self.get(prefix, True):
+            if LABEL_REPLICA in x.labels:
+                indexed[int(x.labels[LABEL_REPLICA])] = x
+            else:
+                unindexed.append(x)
+        return indexed, unindexed
+
+    def _roll_back(self, prefix, batch, kept):
+        # Undo a failed batch of a rolling update: remove whatever new
+        # replicas were created and give the old ones their names
+        # back, so that each index has exactly one replica again.
+        print(f"Rolling back update of {self.name}")
+        client = docker_util.get_client()
+        for i in batch:
+            with contextlib.suppress(docker.errors.NotFound):
+                client.containers.get(f"{prefix}-{self.name}-{i}").remove(
+                    force=True
+                )
+                docker_util.mark_changed()
+        for x, name in kept:
+            x.rename(name)
+
+    def _retire(self, container, timeout):
+        docker_util.container_stop(container, False, self.name, timeout)
+        with docker_util.ignoring_missing():
+            container.remove()
+        docker_util.mark_changed()
+
+    def get(self, prefix, stopped=False, inventory=None):
+        labels = {LABEL_PREFIX: prefix, LABEL_ROLE: self.name}
+        pattern = self.replica_prefix(prefix)
+        if inventory:
+            found = inventory.containers_labelled(labels, stopped)
+            named = inventory.containers_matching(pattern, stopped)
+        else:
+            found = docker_util.containers_labelled(labels, stopped)
+            named = docker_util.containers_matching(pattern, stopped)
+        unlabelled = [x for x in named if LABEL_PREFIX not in x.labels]
+        return found + unlabelled
+
+    def running(self, prefix):
+        n = len(prefix) + 1
+        return {x.name[n:]: x for x in self.get(prefix)}
+
+    def status(self, prefix, inventory=None):
+        containers = self.get(prefix, inventory=inventory)
+        status = tabulate([x.status for x in containers])
         if status:
             ret = ", ".join([f"{k} ({v})" for k, v in status.items()])
         else:
             ret = "missing"
         return ret
 
-    def stop(self, prefix, kill=False):
-        for x in self.get(prefix):
-            docker_util.container_stop(x, kill, self.name)
+    def stop(self, prefix, kill=False, timeout=None, until=None, parallel=1):
+        def stop_one(x):
+            docker_util.container_stop(x, kill, self.name, timeout, until)
+
+        run_parallel(stop_one, self.get(prefix), parallel)
 
-    def remove(self, prefix):
+    def remove(self, prefix, parallel=1):
         containers = self.get(prefix, True)
         if containers:
             print(f"Removing '{self.name}'")
-            for x in containers:
-                x.remove()
+            run_parallel(lambda x: x.remove(), containers, parallel)
+            docker_util.mark_changed()
 
 
 class ConstellationContainerCollection:
     def __init__(self, collection):
         self.collection = collection
+        names = [x.name for x in collection]
+        for x in collection:
+            for dep in x.depends_on:
+                if dep not in names:
+                    msg = f"Container '{x.name}' depends on undefined '{dep}'"
+                    raise Exception(msg)
+        # Check for cycles up front, rather than on start
+        dependency_waves(collection)
 
     def find(self, name):
         for x in self.collection:
@@ -290,25 +908,97 @@ class ConstellationContainerCollection:
     def get(self, name, prefix):
         return self.find(name).get(prefix)
 
-    def exists(self, prefix):
-        return [x.exists(prefix) for x in self.collection]
+    def exists(self, prefix, inventory=None):
+        return [x.exists(prefix, inventory) for x in self.collection]
 
-    def _apply(self, method, *args, subset=None, **kwargs):
+    def running(self, prefix, subset=None):
+        """Running containers, including service replicas, by name."""
+        ret = {}
+        for x in self._subset(subset):
+            ret.update(x.running(prefix))
+        return ret
+
+    def _subset(self, subset):
+        return [
+            x for x in self.collection if subset is None or x.name in subset
+        ]
+
+    def prepare_images(self, *, pull, parallel=1, log=None):
+        """Pull or build the images for every container.
+
+        Containers that share an image are grouped so that each
+        distinct image is only pulled (or built) once, and distinct
+        images are prepared (including built) on up to `parallel`
+        threads.  Build output is passed to `log` (see
+        docker_util.image_build).  The time taken to prepare each image
+        is printed as it finishes, and returned as a dict of seconds
+        per image.
+        """
+        jobs = {}
         for x in self.collection:
-            if subset is None or x.name in subset:
-                x.__getattribute__(method)(*args, **kwargs)
+            jobs.setdefault(image_key(x.image), []).append(x)
+
+        def prepare_one(containers):
+            name = ", ".join(x.name for x in containers)
+            image = containers[0].image
+            t0 = time.monotonic()
+            image_id = prepare_image(name, image, pull=pull, log=log)
+            elapsed = time.monotonic() - t0
+            print(f"    `-> {name} ready in {elapsed:.1f}s")
+            for x in containers:
+                x.image_id = image_id
+            return elapsed
 
-    def prepare_images(self, *, pull):
-        self._apply("prepare_image", pull=pull)
+        timings = run_parallel(prepare_one, jobs.values(), parallel)
+        return dict(zip(jobs.keys(), timings))
 
-    def stop(self, prefix, kill=False):
-        self._apply("stop", prefix, kill)
+    def stop(
+        self,
+        prefix,
+        kill=False,
+        parallel=1,
+        timeout=None,
+        deadline=None,
+        subset=None,
+    ):
+        until = None if deadline is None else time.monotonic() + deadline
 
-    def remove(self, prefix):
-        self._apply("remove", prefix)
+        def stop_one(x):
+            x.stop(prefix, kill, timeout, until, parallel)
 
-    def start(self, prefix, network, volumes, data=None, subset=None):
-        self._apply("start", prefix, network, volumes, data, subset=subset)
+        # Stop dependents before the containers they depend on
+        for wave in reversed(dependency_waves(self._subset(subset))):
+            run_parallel(stop_one, wave, parallel)
+
+    def remove(self, prefix, parallel=1, subset=None):
+        for wave in reversed(dependency_waves(self._subset(subset))):
+            run_parallel(lambda x: x.remove(prefix, parallel), wave, parallel)
+
+    def start(
+        self,
+        prefix,
+        network,
+        volumes,
+        data=None,
+        subset=None,
+        parallel=1,
+        constellation=None,
+        wait_ready=False,
+    ):
+        def start_one(x):
+            x.start(
+                prefix,
+                network,
+                volumes,
+                data,
+                constellation,
+                wait_ready,
+                parallel,
+            )
+
+        # Each container is started as soon as everything it depends
+        # on has started (or, with wait_ready, is ready).
+        run_graph(start_one, self._subset(subset), parallel)
 
 
 class ConstellationVolume:
@@ -319,8 +1009,8 @@ class ConstellationVolume:
     def exists(self):
         return docker_util.volume_exists(self.name)
 
-    def create(self):
-        docker_util.ensure_volume(self.name)
+    def create(self, labels=None):
+        docker_util.ensure_volume(self.name, labels)
 
     def remove(self):
         docker_util.remove_volume(self.name)
@@ -342,9 +1032,9 @@ class ConstellationVolumeCollection:
         msg = f"Mount with role '{role}' not defined"
         raise Exception(msg)
 
-    def create(self):
+    def create(self, labels=None):
         for vol in self.collection:
-            vol.create()
+            vol.create({**labels, LABEL_ROLE: vol.role} if labels else None)
 
     def remove(self):
         for vol in self.collection:
@@ -358,8 +1048,8 @@ class ConstellationNetwork:
     def exists(self):
         return docker_util.network_exists(self.name)
 
-    def create(self):
-        docker_util.ensure_network(self.name)
+    def create(self, labels=None):
+        docker_util.ensure_network(self.name, labels)
 
     def remove(self):
         docker_util.remove_network(self.name)
@@ -392,6 +1082,22 @@ class ConstellationBindMount(_ConstellationMount):
         return docker.types.Mount(self.target, self.source, **self.kwargs)
 
 
+def image_key(image):
+    if isinstance(image, BuildSpec):
+        return repr(image)
+    return str(image)
+
+
+def prepare_image(name, image, *, pull, log=None):
+    if isinstance(image, BuildSpec):
+        return docker_util.image_build(name, image, log)
+    if pull:
+        docker_util.image_pull(name, str(image))
+    else:
+        docker_util.ensure_image(name, str(image))
+    return str(image)
+
+
 def int_into_tuple(i):
     if isinstance(i, int):
         return i, i
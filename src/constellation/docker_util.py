@@ -1,34 +1,107 @@
-import math
+import contextvars
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
 import os
+import posixpath
+import queue
+import re
+import stat
 import tarfile
 import tempfile
+import threading
 import time
+from contextlib import contextmanager, suppress
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
 
 import docker
+from docker.utils.build import exclude_paths
 
-from constellation.util import BuildSpec
+from constellation.util import (
+    LABEL_BUILD,
+    BuildSpec,
+    TailBuffer,
+    label_filters,
+    run_parallel,
+)
 
+# A single client (and so a single connection pool) is shared by
+# everything in the process, unless overridden for a block of code
+# with using_client().  docker-py clients are safe to share between
+# threads, and run_parallel carries any override into its workers.
+_default_client = None
+_default_client_lock = threading.Lock()
+_client = contextvars.ContextVar("constellation_docker_client", default=None)
 
-def ensure_network(name):
-    client = docker.client.from_env()
+
+def get_client():
+    client = _client.get()
+    if client is not None:
+        return client
+    global _default_client  # noqa: PLW0603
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = docker.client.from_env()
+        return _default_client
+
+
+def set_default_client(client):
+    global _default_client  # noqa: PLW0603
+    with _default_client_lock:
+        _default_client = client
+
+
+@contextmanager
+def using_client(client):
+    token = _client.set(client)
+    try:
+        yield client
+    finally:
+        _client.reset(token)
+
+
+# Incremented whenever we create, stop or remove something, so that
+# any Inventory snapshot taken before then knows it is out of date.
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def mark_changed():
+    global _generation  # noqa: PLW0603
+    with _generation_lock:
+        _generation += 1
+
+
+def generation():
+    return _generation
+
+
+def ensure_network(name, labels=None):
+    client = get_client()
     try:
         client.networks.get(name)
     except docker.errors.NotFound:
         print(f"Creating docker network '{name}'")
-        client.networks.create(name)
+        client.networks.create(name, labels=labels)
+        mark_changed()
 
 
-def ensure_volume(name):
-    client = docker.client.from_env()
+def ensure_volume(name, labels=None):
+    client = get_client()
     try:
         client.volumes.get(name)
     except docker.errors.NotFound:
         print(f"Creating docker volume '{name}'")
-        client.volumes.create(name)
+        client.volumes.create(name, labels=labels)
+        mark_changed()
 
 
 def ensure_image(name, image):
-    client = docker.client.from_env()
+    client = get_client()
     try:
         client.images.get(str(image))
     except docker.errors.NotFound:
@@ -45,7 +118,7 @@ def exec_safely(container, args, **kwargs):
 
 
 def return_logs_and_remove(image, args=None, mounts=None):
-    client = docker.client.from_env()
+    client = get_client()
     try:
         result = client.containers.run(
             image, args, mounts=mounts, stderr=True, remove=True
@@ -55,35 +128,266 @@ def return_logs_and_remove(image, args=None, mounts=None):
     return result.decode("UTF-8")
 
 
+# Default amount of output (in bytes) kept for reporting errors from
+# the streaming functions below.
+TAIL = 65536
+
+
+def exec_stream(container, args, tail=TAIL, timeout=None, **kwargs):
+    """Run a command in a container, streaming its output.
+
+    Yields ("stdout", bytes) and ("stderr", bytes) pairs as output
+    arrives, so memory use does not grow with the amount of output.
+    If the command fails, the last `tail` bytes of output are printed
+    and an exception raised.  If `timeout` seconds pass first an
+    exception is raised; docker provides no way of stopping an
+    exec'd process so the command itself is left running.
+    """
+    exec_id, chunks = _exec_start(container, args, **kwargs)
+    buf = TailBuffer(tail)
+    for stream, data in _with_timeout(_demux(chunks), timeout):
+        buf.append(data)
+        yield stream, data
+    if _exec_exit_code(exec_id) != 0:
+        _print_tail(buf)
+        msg = "Error running command (see above for log)"
+        raise Exception(msg)
+
+
+@dataclass
+class ExecReport:
+    """The outcome of running a command in one container.
+
+    `output` holds the last bytes of stdout and stderr combined, and
+    `error` describes any failure to run the command at all (in which
+    case `exit_code` is None).
+    """
+
+    name: str
+    exit_code: Optional[int]
+    output: bytes
+    duration: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+class ExecError(Exception):
+    """A command failed in some of the containers passed to exec_all.
+
+    `reports` holds the ExecReport for every container, by name.
+    """
+
+    def __init__(self, msg, reports):
+        super().__init__(msg)
+        self.reports = reports
+
+
+def exec_all(
+    containers, args, parallel=4, timeout=None, tail=TAIL, check=True, **kwargs
+):
+    """Run a command in many containers at once.
+
+    `containers` is a dict of containers by name; the command runs in
+    up to `parallel` of them at once, each allowed `timeout` seconds.
+    Returns a dict of ExecReport by name.  Every container finishes
+    (or times out) before any failure is reported; with `check`, the
+    output of each failure is printed and an ExecError raised.
+    """
+
+    def run_one(name):
+        buf = TailBuffer(tail)
+        t0 = time.monotonic()
+        try:
+            exec_id, chunks = _exec_start(containers[name], args, **kwargs)
+            for _stream, data in _with_timeout(_demux(chunks), timeout):
+                buf.append(data)
+            exit_code, error = _exec_exit_code(exec_id), None
+        except Exception as e:
+            exit_code, error = None, str(e)
+        duration = time.monotonic() - t0
+        return ExecReport(name, exit_code, buf.getvalue(), duration, error)
+
+    names = list(containers)
+    res = dict(zip(names, run_parallel(run_one, names, parallel)))
+    failed = [x for x in res.values() if not x.ok]
+    if failed and check:
+        for x in failed:
+            reason = x.error or f"exit code {x.exit_code}"
+            print(f"'{x.name}' failed ({reason}):")
+            print(x.output.decode("UTF-8", errors="replace"))
+        names = ", ".join(x.name for x in failed)
+        msg = (
+            f"Error running command in {len(failed)} of {len(res)} "
+            f"containers: {names} (see above for logs)"
+        )
+        raise ExecError(msg, res)
+    return res
+
+
+def stream_logs_and_remove(
+    image, args=None, mounts=None, tail=TAIL, timeout=None
+):
+    """Run a one-shot container, streaming its output.
+
+    The streaming counterpart of return_logs_and_remove: yields
+    ("stdout", bytes) and ("stderr", bytes) pairs as output arrives.
+    If the container exits with an error, the last `tail` bytes of
+    output are printed and an exception raised.  If `timeout`
+    seconds pass first the container is killed.  The container is
+    always removed.
+    """
+    client = get_client()
+    try:
+        container = client.containers.create(image, args, mounts=mounts)
+    except docker.errors.ImageNotFound:
+        # As containers.run does, so that this works wherever
+        # return_logs_and_remove does.
+        client.images.pull(image)
+        container = client.containers.create(image, args, mounts=mounts)
+    try:
+        # Attach before starting so that no output is missed
+        chunks = client.api.attach(
+            container.id, stream=True, logs=True, demux=True
+        )
+        container.start()
+        buf = TailBuffer(tail)
+
+        def kill():
+            with suppress(docker.errors.APIError):
+                container.kill()
+
+        for stream, data in _with_timeout(_demux(chunks), timeout, kill):
+            buf.append(data)
+            yield stream, data
+        if container.wait()["StatusCode"] != 0:
+            _print_tail(buf)
+            msg = "Error running container (see above for log)"
+            raise Exception(msg)
+    finally:
+        with suppress(docker.errors.NotFound):
+            container.remove(force=True)
+
+
+def _exec_start(container, args, **kwargs):
+    api = get_client().api
+    exec_id = api.exec_create(
+        container.id, args, stdout=True, stderr=True, **kwargs
+    )["Id"]
+    return exec_id, api.exec_start(exec_id, stream=True, demux=True)
+
+
+def _exec_exit_code(exec_id):
+    return get_client().api.exec_inspect(exec_id)["ExitCode"]
+
+
+def _demux(chunks):
+    for stdout, stderr in chunks:
+        if stdout:
+            yield "stdout", stdout
+        if stderr:
+            yield "stderr", stderr
+
+
+def _print_tail(buf):
+    print(buf.getvalue().decode("UTF-8", errors="replace"))
+
+
+def _with_timeout(items, timeout, on_timeout=None):
+    # Reading from docker blocks until data arrives, so to enforce a
+    # timeout we read on a separate thread and wait on a (small)
+    # queue here instead.
+    if timeout is None:
+        yield from items
+        return
+    until = time.monotonic() + timeout
+    chunks = queue.Queue(16)
+    finished = threading.Event()
+
+    def put(item):
+        while not finished.is_set():
+            with suppress(queue.Full):
+                chunks.put(item, timeout=0.1)
+                return
+
+    def read():
+        try:
+            for x in items:
+                put((True, x))
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    ctx = contextvars.copy_context()
+    threading.Thread(target=ctx.run, args=(read,), daemon=True).start()
+    try:
+        while True:
+            try:
+                ok, x = chunks.get(timeout=max(until - time.monotonic(), 0))
+            except queue.Empty:
+                if on_timeout:
+                    on_timeout()
+                msg = f"Timed out after {timeout} seconds"
+                raise Exception(msg) from None
+            if ok:
+                yield x
+            elif x is None:
+                return
+            else:
+                raise x
+    finally:
+        finished.set()
+
+
 def remove_network(name):
-    client = docker.client.from_env()
+    client = get_client()
     try:
         nw = client.networks.get(name)
     except docker.errors.NotFound:
         return
     print(f"Removing network '{name}'")
     nw.remove()
+    mark_changed()
 
 
 def remove_volume(name):
-    client = docker.client.from_env()
+    client = get_client()
     try:
         v = client.volumes.get(name)
     except docker.errors.NotFound:
         return
     print(f"Removing volume '{name}'")
     v.remove(name)
+    mark_changed()
+
 
+# Seconds docker gives a container to stop, unless configured
+# otherwise
+STOP_TIMEOUT = 10
 
-def container_stop(container, kill, name):
+
+# 'until' is a time.monotonic() value after which the container
+# should be killed rather than given any more time to stop.  Without
+# a timeout, docker's default is used unless that would run past it.
+def container_stop(container, kill, name, timeout=None, until=None):
     if container and container.status == "running":
+        if until is not None:
+            remaining = int(until - time.monotonic())
+            if remaining <= 0:
+                kill = True
+            elif remaining < (STOP_TIMEOUT if timeout is None else timeout):
+                timeout = remaining
         action = "Killing" if kill else "Stop"
         print(f"{action} '{name}'")
         with ignoring_missing():
             if kill:
                 container.kill()
             else:
-                container.stop()
+                container.stop(timeout=timeout)
+        mark_changed()
 
 
 def container_exists(name):
@@ -98,57 +402,172 @@ def volume_exists(name):
     return docker_exists("volumes", name)
 
 
+def image_id(ref):
+    return get_client().images.get(ref).id
+
+
 def image_exists(name):
     return docker_exists("images", name)
 
 
 def docker_exists(collection, name):
-    client = docker.client.from_env()
+    client = get_client()
     try:
-        client.__getattribute__(collection).get(name)
+        getattr(client, collection).get(name)
         return True
     except docker.errors.NotFound:
         return False
 
 
+def container_events(ids, since, until):
+    """Stream events for a set of containers.
+
+    `since` and `until` are time.time() values; the stream finishes
+    once the daemon's clock passes `until`.  Close the returned stream
+    to stop early.
+    """
+    client = get_client()
+    filters = {"type": "container", "container": list(ids)}
+    return client.events(
+        since=f"{since:.6f}", until=f"{until:.6f}", filters=filters, decode=True
+    )
+
+
+def _event_action(event):
+    return event.get("Action") or event.get("status")
+
+
+def _event_id(event):
+    return event.get("id") or event["Actor"]["ID"]
+
+
+def _has_healthcheck(container):
+    return "Health" in container.attrs["State"]
+
+
 # https://medium.com/@nagarwal/lifecycle-of-docker-container-d2da9f85959
-def container_wait_running(container, poll=0.1, timeout=1):
-    for _i in range(math.ceil(timeout / poll)):
-        if container.status != "created":
-            break
-        time.sleep(poll)
-        container.reload()
-    if container.status != "running":
-        msg = (
-            f"container '{container.name}' ({container.id[:8]}) "
-            f"is not running ({container.status})"
-        )
-        raise Exception(msg)
-    time.sleep(timeout)
-    container.reload()
-    if container.status != "running":
-        msg = (
-            f"container '{container.name}' ({container.id[:8]}) "
-            f"was running but is now {container.status}"
-        )
-        raise Exception(msg)
-    return container
+def containers_wait_running(containers, timeout=1):
+    """Wait until several containers are running and look stable.
 
+    A container with a healthcheck is done as soon as it reports
+    healthy.  Any other container must start within `timeout` seconds
+    and still be running at the end of that time.  All containers are
+    watched through a single docker event stream, so waiting for many
+    containers costs no more than waiting for one, and the first
+    container to stop or become unhealthy raises an error straight
+    away.
+    """
+    since = time.time()
+    until = since + timeout
+    pending = {}
+    for x in containers:
+        x.reload()
+        if x.status not in ("created", "running"):
+            _raise_not_running(x)
+        if not (_has_healthcheck(x) and x.health == "healthy"):
+            pending[x.id] = x
+    if not pending:
+        return containers
 
-def container_remove_wait(container, poll=0.1, timeout=1):
-    name = container.name
-    for _i in range(math.ceil(timeout / poll)):
-        try:
-            container.remove()
-        except docker.errors.APIError:
-            pass
-        time.sleep(poll)
+    events = container_events(pending.keys(), since, until)
+    try:
+        for event in events:
+            x = pending.get(_event_id(event))
+            if x is None:
+                continue
+            action = _event_action(event)
+            if action == "die":
+                x.reload()
+                msg = (
+                    f"container '{x.name}' ({x.id[:8]}) "
+                    f"was running but is now {x.status}"
+                )
+                raise Exception(msg)
+            if action == "health_status: unhealthy":
+                msg = f"container '{x.name}' ({x.id[:8]}) is unhealthy"
+                raise Exception(msg)
+            if action == "health_status: healthy":
+                # Refresh so that callers see the healthy status
+                x.reload()
+                del pending[x.id]
+                if not pending:
+                    break
+    finally:
+        events.close()
 
-    for _i in range(math.ceil(timeout / poll)):
-        if not container_exists(name):
+    for x in pending.values():
+        x.reload()
+        if x.status != "running":
+            _raise_not_running(x)
+    return containers
+
+
+def containers_wait_healthy(containers, timeout):
+    """Wait until containers with a healthcheck report healthy.
+
+    Like containers_wait_running, except that running but not yet
+    healthy at the end of `timeout` is an error.
+    """
+    containers_wait_running(containers, timeout)
+    for x in containers:
+        if _has_healthcheck(x) and x.health != "healthy":
+            msg = (
+                f"container '{x.name}' ({x.id[:8]}) "
+                f"was not healthy in time ({x.health})"
+            )
+            raise Exception(msg)
+    return containers
+
+
+def _raise_not_running(container):
+    msg = (
+        f"container '{container.name}' ({container.id[:8]}) "
+        f"is not running ({container.status})"
+    )
+    raise Exception(msg)
+
+
+# 'poll' is no longer used, now that we wait on docker events, but is
+# kept so that existing callers continue to work.
+def container_wait_running(container, poll=0.1, timeout=1):  # noqa: ARG001
+    return containers_wait_running([container], timeout)[0]
+
+
+def _try_remove(container):
+    try:
+        container.remove()
+    except docker.errors.NotFound:
+        pass
+    except docker.errors.APIError:
+        return False
+    mark_changed()
+    return True
+
+
+def container_remove_wait(container, poll=0.1, timeout=1):  # noqa: ARG001
+    """Remove a container as soon as it has stopped.
+
+    Waits up to `timeout` seconds for the container to exit (it is
+    not stopped for you), returning as soon as it has been removed.
+    """
+    name = container.name
+    since = time.time()
+    events = container_events([container.id], since, since + timeout)
+    try:
+        if _try_remove(container):
             return
-        time.sleep(poll)
+        for event in events:
+            action = _event_action(event)
+            if action == "destroy":
+                mark_changed()
+                return
+            if action == "die" and _try_remove(container):
+                return
+    finally:
+        events.close()
 
+    if not container_exists(name):
+        return
     msg = f"container '{name}' was not removed in time"
     raise Exception(msg)
 
@@ -163,16 +582,36 @@ def simple_tar(path, name):
     return f
 
 
-def simple_tar_string(text, name):
+def simple_tar_string(text, name, mode=0o600, uid=None, gid=None, mtime=None):
+    """Build a tar (in memory) containing `text` as the file `name`.
+
+    As when this was tarred from a temporary file, the file is only
+    readable by its owner, the local user, unless given otherwise.
+    """
     if isinstance(text, str):
         text = bytes(text, "utf-8")
-    try:
-        fd, tmp = tempfile.mkstemp(text=True)
-        with os.fdopen(fd, "wb") as f:
-            f.write(text)
-        return simple_tar(tmp, name)
-    finally:
-        os.remove(tmp)
+    f = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=f) as t:
+        info = tar_info(name, len(text), mode, uid, gid, mtime)
+        t.addfile(info, io.BytesIO(text))
+    f.seek(0)
+    return f
+
+
+def tar_info(name, size, mode=0o600, uid=None, gid=None, mtime=None):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = mode
+    info.uid = _local_id("getuid") if uid is None else uid
+    info.gid = _local_id("getgid") if gid is None else gid
+    info.mtime = time.time() if mtime is None else mtime
+    return info
+
+
+# What tarfile records for a local file's owner; there is no uid on
+# windows.
+def _local_id(what):
+    return getattr(os, what, lambda: 0)()
 
 
 # The python docker client does not provide nice 'docker cp' wrappers
@@ -183,33 +622,537 @@ def simple_tar_string(text, name):
 #
 # So this function assumes that the destination directory exists and
 # dumps out text into a file in the container
-def string_into_container(txt, container, path):
-    with simple_tar_string(txt, os.path.basename(path)) as tar:
+#
+# With `skip_unchanged`, these compare the content with any file
+# already at the destination (see container_hashes) and only upload
+# if it differs, returning True if anything was uploaded.  Changes to
+# only the mode or owner of a file are not detected.
+def string_into_container(
+    txt,
+    container,
+    path,
+    mode=0o600,
+    uid=None,
+    gid=None,
+    mtime=None,
+    *,
+    skip_unchanged=False,
+):
+    if skip_unchanged and _unchanged(container, {path: sha256(txt)}):
+        return False
+    name = os.path.basename(path)
+    with simple_tar_string(txt, name, mode, uid, gid, mtime) as tar:
         container.put_archive(os.path.dirname(path), tar)
+    return True
+
+
+def file_into_container(
+    local_path,
+    container,
+    destination_path,
+    name,
+    compression=None,
+    *,
+    skip_unchanged=False,
+):
+    if skip_unchanged:
+        dest = posixpath.join(destination_path, name)
+        if _unchanged(container, {dest: sha256(Path(local_path))}):
+            return False
+    abs_path = os.path.abspath(local_path)
+
+    def build(t):
+        t.add(abs_path, arcname=name, recursive=False)
+
+    tar = tar_stream(build, compression=compression)
+    container.put_archive(destination_path, tar)
+    return True
+
+
+def sha256(source):
+    """The sha256 of content (str or bytes) or of a local file (a Path)."""
+    h = hashlib.sha256()
+    if isinstance(source, str):
+        h.update(bytes(source, "utf-8"))
+    elif isinstance(source, bytes):
+        h.update(source)
+    else:
+        with open(source, "rb") as f:
+            while chunk := f.read(65536):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def container_hashes(container, paths):
+    """The sha256 of files in a container, by path.
+
+    Uses `sha256sum` within the container; files that are missing (or
+    all of them, if sha256sum is not available or the container is
+    not running, e.g., in a preconfigure hook) are omitted.
+    """
+    if not paths:
+        return {}
+    try:
+        _exit_code, (stdout, _stderr) = container.exec_run(
+            ["sha256sum", *paths], demux=True
+        )
+    except docker.errors.APIError:
+        return {}
+    ret = {}
+    for line in (stdout or b"").decode("UTF-8", errors="replace").splitlines():
+        # Unusual file names are escaped, and marked with a leading
+        # backslash; we just treat them as changed.
+        digest, sep, path = line.partition("  ")
+        if sep and not digest.startswith("\\"):
+            ret[path] = digest
+    return ret
 
 
-def file_into_container(local_path, container, destination_path, name):
-    tar = simple_tar(local_path, name)
+def _unchanged(container, hashes):
+    return container_hashes(container, list(hashes)) == hashes
+
+
+def path_into_container(
+    local_path,
+    container,
+    destination_path,
+    *,
+    include=None,
+    exclude=None,
+    uid=None,
+    gid=None,
+    compression=None,
+):
+    """Copy a local file or directory (recursively) into a container.
+
+    As with `docker cp`, `local_path` is copied into the existing
+    directory `destination_path` under its own name.  Within a
+    directory, files are copied only if their path (relative to
+    `local_path`) matches one of the glob patterns in `include` (if
+    given) and none of those in `exclude`; directories matching
+    `exclude` are skipped entirely.  Files keep their local mode, and
+    their owner unless `uid` or `gid` are given.  The archive is
+    produced (and optionally compressed; see tar_stream) as it is
+    uploaded, so nothing is written to disk and the upload starts
+    immediately.
+    """
+    abs_path = os.path.abspath(local_path)
+    top = os.path.basename(abs_path)
+
+    def owned(info):
+        if uid is not None:
+            info.uid, info.uname = uid, ""
+        if gid is not None:
+            info.gid, info.gname = gid, ""
+        return info
+
+    def build(t):
+        t.add(abs_path, arcname=top, recursive=False, filter=owned)
+        for rel in walk_filtered(abs_path, include, exclude):
+            name = f"{top}/{rel}"
+            full = os.path.join(abs_path, rel)
+            t.add(full, arcname=name, recursive=False, filter=owned)
+
+    tar = tar_stream(build, compression=compression)
     container.put_archive(destination_path, tar)
 
 
+def walk_filtered(path, include=None, exclude=None):
+    """Relative paths of directories and files below `path`, filtered.
+
+    Patterns are matched (with fnmatch) against the path relative to
+    `path`, using "/" as the separator.
+    """
+    if not os.path.isdir(path):
+        return
+    for root, dirs, files in os.walk(path):
+        rel_root = os.path.relpath(root, path).replace(os.sep, "/")
+        prefix = "" if rel_root == "." else f"{rel_root}/"
+        dirs[:] = sorted(
+            d for d in dirs if not _matches_any(prefix + d, exclude)
+        )
+        for d in dirs:
+            yield prefix + d
+        for f in sorted(files):
+            rel = prefix + f
+            if include is not None and not _matches_any(rel, include):
+                continue
+            if not _matches_any(rel, exclude):
+                yield rel
+
+
+def _matches_any(path, patterns):
+    return any(fnmatch.fnmatch(path, p) for p in patterns or ())
+
+
+def tar_stream(build, chunk_size=65536, compression=None):
+    """Yield a tar archive in chunks as it is produced.
+
+    `build` is called with an open tarfile on a separate thread; what
+    it writes is passed back through a small queue, so the archive
+    is never held in full in memory or on disk.  Suitable for passing
+    to put_archive, which uploads it as it is produced.  With
+    `compression` ("gzip", or "zstd" if the zstandard package is
+    installed) the archive is compressed as it is written, which
+    docker decompresses on receipt.
+    """
+    if compression is not None:
+        _check_compression(compression)
+    return _tar_chunks(build, chunk_size, compression)
+
+
+def _tar_chunks(build, chunk_size, compression):
+    chunks = queue.Queue(4)
+    finished = threading.Event()
+
+    def put(item):
+        while not finished.is_set():
+            with suppress(queue.Full):
+                chunks.put(item, timeout=0.1)
+                return
+
+    def produce():
+        try:
+            raw = _QueueWriter(put)
+            with io.BufferedWriter(raw, chunk_size) as f:
+                with _compressing(f, compression) as out:
+                    with tarfile.open(mode="w|", fileobj=out) as t:
+                        build(t)
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    ctx = contextvars.copy_context()
+    threading.Thread(target=ctx.run, args=(produce,), daemon=True).start()
+    try:
+        while True:
+            ok, x = chunks.get()
+            if ok:
+                yield x
+            elif x is None:
+                return
+            else:
+                raise x
+    finally:
+        finished.set()
+
+
+class _QueueWriter(io.RawIOBase):
+    # The writing counterpart of _ChunkStream, passing each block
+    # written to `put`.
+    def __init__(self, put):
+        self._put = put
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._put((True, bytes(b)))
+        return len(b)
+
+
+# Batches smaller than this are built in memory, larger ones are
+# streamed
+SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def files_into_container(
+    container,
+    entries,
+    uid=0,
+    gid=0,
+    compression=None,
+    *,
+    skip_unchanged=False,
+):
+    """Copy many files into a container with a single request.
+
+    Each entry is a tuple of (source, destination) or (source,
+    destination, mode), where source is either the content of the
+    file (a str or bytes) or a pathlib.Path to a local file, and
+    destination is an absolute path in the container.  Without a
+    mode, content is written as 0644 and local files keep their mode.
+
+    Everything is uploaded as one tar, relative to the deepest
+    directory containing all the destinations, which must already
+    exist.  The tar holds only the files themselves, so existing
+    directories are left untouched; docker creates any missing
+    directories below that (as 0755, owned by root).  Large batches, or any
+    batch with `compression`, are streamed as with tar_stream.
+
+    With `skip_unchanged`, only entries whose content differs from
+    the file at their destination are uploaded (see
+    string_into_container).  Returns the destinations uploaded.
+    """
+    entries = [_file_entry(*x) for x in entries]
+    if entries and skip_unchanged:
+        hashes = {x[1]: sha256(x[0]) for x in entries}
+        existing = container_hashes(container, list(hashes))
+        entries = [x for x in entries if existing.get(x[1]) != hashes[x[1]]]
+    if not entries:
+        return []
+    root = os.path.commonpath([os.path.dirname(x[1]) for x in entries])
+    size = sum(
+        len(x[0]) if isinstance(x[0], bytes) else os.path.getsize(x[0])
+        for x in entries
+    )
+
+    def build(t):
+        for source, dest, mode in entries:
+            name = os.path.relpath(dest, root)
+            _add_file(t, source, name, mode, uid, gid)
+
+    if size < SPOOL_SIZE and compression is None:
+        f = io.BytesIO()
+        with tarfile.open(mode="w", fileobj=f) as t:
+            build(t)
+        container.put_archive(root, f.getvalue())
+    else:
+        container.put_archive(root, tar_stream(build, compression=compression))
+    return [x[1] for x in entries]
+
+
+def _add_file(t, source, name, mode, uid, gid):
+    if isinstance(source, bytes):
+        info = tar_info(name, len(source), mode or 0o644, uid, gid)
+        t.addfile(info, io.BytesIO(source))
+    else:
+        info = t.gettarinfo(source, arcname=name)
+        info.mode = info.mode if mode is None else mode
+        info.uid, info.gid = uid, gid
+        info.uname = info.gname = ""
+        with open(source, "rb") as src:
+            t.addfile(info, src)
+
+
+def _file_entry(source, dest, mode=None):
+    if not os.path.isabs(dest):
+        msg = f"Destination '{dest}' is not an absolute path"
+        raise Exception(msg)
+    if isinstance(source, str):
+        source = bytes(source, "utf-8")
+    return source, dest, mode
+
+
 def string_from_container(container, path):
     return bytes_from_container(container, path).decode("utf-8")
 
 
-def bytes_from_container(container, path):
-    stream, _status = container.get_archive(path)
+def bytes_from_container(container, path, compression=None):
+    return b"".join(
+        stream_from_container(container, path, compression=compression)
+    )
+
+
+def stream_from_container(container, path, chunk_size=65536, compression=None):
+    """Yield the contents of the file `path` in a container in chunks.
+
+    The archive sent by docker is read as it arrives, so only one
+    chunk is held in memory at a time.  See archive_from_container
+    for `compression`.
+    """
+    stream, raw = _archive_streams(container, path, compression)
+    with tarfile.open(mode="r|", fileobj=stream) as t:
+        for member in t:
+            if member.name == os.path.basename(path):
+                f = t.extractfile(member)
+                if f is None:
+                    msg = f"'{path}' is not a regular file"
+                    raise Exception(msg)
+                while chunk := f.read(chunk_size):
+                    yield chunk
+                _drain(raw)
+                return
+    _drain(raw)
+    msg = f"'{path}' not found in archive"
+    raise Exception(msg)
+
+
+def directory_from_container(container, path, destination, compression=None):
+    """Copy the directory `path` from a container into `destination`.
+
+    The contents of `path` (rather than the directory itself) are
+    written into the local directory `destination`, which is created
+    if needed.  Files are extracted as the archive arrives, so nothing
+    is held in memory or spooled to disk along the way.  See
+    archive_from_container for `compression`.
+    """
+    stream, raw = _archive_streams(container, path, compression)
+    top = os.path.basename(path.rstrip("/"))
+    os.makedirs(destination, exist_ok=True)
+    with tarfile.open(mode="r|", fileobj=stream) as t:
+        for member in t:
+            name = _strip_top(member.name, top)
+            if not name:
+                continue
+            member.name = name
+            if member.islnk():
+                member.linkname = _strip_top(member.linkname, top)
+            t.extract(member, destination, **_EXTRACT_ARGS)
+    _drain(raw)
+
+
+def _drain(stream):
+    # tarfile stops reading at the end-of-archive marker; read to the
+    # end so that any error creating the archive (reported once the
+    # stream is exhausted, see _exec_stdout) is not missed.  This is
+    # the stream as received, as a decompressor may stop at the end of
+    # its first frame.
+    while stream.read(65536):
+        pass
+
+
+def archive_from_container(container, path, compression=None):
+    """A readable stream of a tar archive of `path` in a container.
+
+    Docker only sends uncompressed archives, so with `compression`
+    ("gzip" or "zstd") the archive is instead created by running tar
+    and the compressor within the container, which must have them
+    available, and decompressed as it is read.  This is worthwhile
+    for compressible data coming from a remote docker daemon.
+    """
+    return _archive_streams(container, path, compression)[0]
+
+
+# The archive, and the stream it is read from (which differ when
+# decompressing).
+def _archive_streams(container, path, compression):
+    if compression is None:
+        stream, _status = container.get_archive(path)
+        stream = _chunk_reader(stream)
+        return stream, stream
+    _check_compression(compression)
+    path = path.rstrip("/") or "/"
+    args = [
+        "sh",
+        "-c",
+        _ARCHIVE_SCRIPT.format(compression=compression),
+        "sh",
+        os.path.dirname(path),
+        os.path.basename(path),
+    ]
+    raw = _chunk_reader(_exec_stdout(container, args))
+    return _decompressing(raw, compression), raw
+
+
+# Create a compressed archive of "$2" within "$1".  The exit status
+# of a pipeline is that of its last command, so hiding any failure of
+# tar; without relying on "set -o pipefail", which not all shells
+# support, we collect the status of both tar and the compressor on
+# fd 3 and fail if either did.
+_ARCHIVE_SCRIPT = """exec 4>&1
+codes=$( {{ {{ tar -cf - -C "$1" "$2"; echo $? >&3; }} \\
+    | {compression} -c >&4 || echo $? >&3; }} 3>&1 )
+for code in $codes; do [ "$code" = 0 ] || exit "$code"; done"""
+
+
+def _exec_stdout(container, args):
+    exec_id, chunks = _exec_start(container, args)
+    stderr = TailBuffer(TAIL)
+    for stream, data in _demux(chunks):
+        if stream == "stdout":
+            yield data
+        else:
+            stderr.append(data)
+    if _exec_exit_code(exec_id) != 0:
+        _print_tail(stderr)
+        msg = "Error creating archive (see above for log)"
+        raise Exception(msg)
+
+
+COMPRESSION = ("gzip", "zstd")
+
+
+def _check_compression(compression):
+    if compression not in COMPRESSION:
+        msg = f"Unknown compression '{compression}'"
+        raise Exception(msg)
+    if compression == "zstd":
+        _zstandard()
+
+
+def _zstandard():
     try:
-        fd, tmp = tempfile.mkstemp(text=False)
-        with os.fdopen(fd, "wb") as f:
-            for d in stream:
-                f.write(d)
-        with open(tmp, "rb") as f:
-            t = tarfile.open(mode="r", fileobj=f)
-            p = t.extractfile(os.path.basename(path))
-            return p.read()
-    finally:
-        os.remove(tmp)
+        import zstandard
+    except ImportError:
+        msg = "zstd compression requires the 'zstandard' package"
+        raise Exception(msg) from None
+    return zstandard
+
+
+def _compressing(f, compression):
+    # The returned file must be closed (to finish compression) before
+    # `f` is; closing it leaves `f` open.
+    if compression is None:
+        return _Unclosed(f)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb")
+    return _zstandard().ZstdCompressor().stream_writer(f, closefd=False)
+
+
+def _decompressing(f, compression):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    # Tolerate archives written as several frames
+    return (
+        _zstandard()
+        .ZstdDecompressor()
+        .stream_reader(f, read_across_frames=True)
+    )
+
+
+class _Unclosed:
+    # Wrap a file so that it is not closed when used as a context
+    # manager, to match the compressing writers above.
+    def __init__(self, f):
+        self._f = f
+
+    def __enter__(self):
+        return self._f
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+# Refuse absolute paths, links out of the destination, device files
+# etc. where python supports it (3.12, and backported to security
+# releases of earlier versions).
+_EXTRACT_ARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+def _strip_top(name, top):
+    parts = name.split("/", 1)
+    if parts[0] != top:
+        msg = f"Unexpected entry '{name}' in archive"
+        raise Exception(msg)
+    return parts[1] if len(parts) > 1 else ""
+
+
+class _ChunkStream(io.RawIOBase):
+    # Present an iterator of byte chunks (as returned by docker-py's
+    # streaming endpoints) as a readable file, for tarfile.
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def _chunk_reader(chunks):
+    return io.BufferedReader(_ChunkStream(chunks))
 
 
 # NOTE: you have to be careful here because the default python docker
@@ -217,7 +1160,7 @@ def bytes_from_container(container, path):
 # is to pull *all* images, which is surprising.
 # https://docker-py.readthedocs.io/en/stable/images.html
 def image_pull(name, ref):
-    client = docker.client.from_env()
+    client = get_client()
     print(f"Pulling docker image {name} ({ref})")
     try:
         prev = client.images.get(ref).short_id
@@ -229,17 +1172,112 @@ def image_pull(name, ref):
     return prev != curr
 
 
-def image_build(name: str, spec: BuildSpec):
-    client = docker.client.from_env()
+def image_build(name: str, spec: BuildSpec, log=None):
+    """Build an image from `spec`, unless it has already been built.
+
+    If given, `log` is called with `name` and each line of build
+    output as it arrives.  Builds may run concurrently (see
+    ConstellationContainerCollection.prepare_images), in which case
+    so will `log`.
+    """
+    client = get_client()
+    fingerprint = build_fingerprint(spec)
+    filters = {"label": [f"{LABEL_BUILD}={fingerprint}"]}
+    existing = client.images.list(filters=filters)
+    if existing:
+        print(f"Using existing docker image for {name} (context unchanged)")
+        print(f"    `-> {existing[0].id}")
+        return existing[0].id
     print(f"Building docker image for {name} from {spec.path}")
-    image, _ = client.images.build(path=spec.path)
-    print(f"    `-> {image.id}")
-    return image.id
+    image_id = None
+    output = client.api.build(
+        path=spec.path,
+        dockerfile=spec.dockerfile,
+        buildargs=spec.buildargs,
+        target=spec.target,
+        cache_from=spec.cache_from,
+        labels={**(spec.labels or {}), LABEL_BUILD: fingerprint},
+        rm=True,
+        decode=True,
+    )
+    for chunk in output:
+        if "error" in chunk:
+            msg = f"Error building image for {name}: {chunk['error'].strip()}"
+            raise Exception(msg)
+        if log and "stream" in chunk:
+            for line in chunk["stream"].splitlines():
+                log(name, line)
+        aux = chunk.get("aux")
+        if isinstance(aux, dict) and "ID" in aux:
+            image_id = aux["ID"]
+    if image_id is None:
+        msg = f"Building image for {name} did not report an image id"
+        raise Exception(msg)
+    print(f"    `-> {image_id}")
+    return image_id
+
+
+def build_fingerprint(spec: BuildSpec):
+    """Hash everything that goes into building an image from `spec`.
+
+    This covers the name, type, mode and content of every file in the
+    build context that docker would send (i.e., respecting any
+    .dockerignore file), along with the other build options.  An
+    image built from the same context with the same options has the
+    same fingerprint, so need not be built again.
+    """
+    root = os.path.abspath(spec.path)
+    h = hashlib.sha256()
+    options = {k: v for k, v in asdict(spec).items() if k != "path"}
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    dockerfile = spec.dockerfile
+    if dockerfile and os.path.isabs(dockerfile):
+        if os.path.commonpath([root, dockerfile]) == root:
+            dockerfile = os.path.relpath(dockerfile, root)
+        else:
+            # docker-py sends a Dockerfile from outside the context
+            # along with it.
+            h.update(sha256(Path(dockerfile)).encode())
+            dockerfile = None
+    patterns = _dockerignore(root)
+    for rel in sorted(exclude_paths(root, patterns, dockerfile)):
+        full = os.path.join(root, rel)
+        st = os.lstat(full)
+        # Modification times are deliberately ignored, as they are
+        # by docker's build cache.
+        h.update(f"\0{rel}\0{st.st_mode:o}\0".encode())
+        if stat.S_ISLNK(st.st_mode):
+            h.update(os.readlink(full).encode())
+        elif stat.S_ISREG(st.st_mode):
+            h.update(sha256(Path(full)).encode())
+    return h.hexdigest()
+
+
+def _dockerignore(root):
+    # As read by docker-py when building
+    path = os.path.join(root, ".dockerignore")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = [x.strip() for x in f.read().splitlines()]
+    return [x for x in lines if x and not x.startswith("#")]
 
 
 def containers_matching(prefix, stopped):
-    cl = docker.client.from_env()
-    return [x for x in cl.containers.list(stopped) if x.name.startswith(prefix)]
+    cl = get_client()
+    # The name filter is an unanchored regular expression
+    filters = {"name": f"^/{re.escape(prefix)}"}
+    return [
+        x
+        for x in cl.containers.list(stopped, filters=filters)
+        if x.name.startswith(prefix)
+    ]
+
+
+def containers_labelled(labels, stopped):
+    cl = get_client()
+    filters = {"label": label_filters(labels)}
+    return cl.containers.list(stopped, filters=filters)
 
 
 # this would be more naturally done with something from contextlib
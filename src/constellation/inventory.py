@@ -0,0 +1,133 @@
+import copy
+import re
+
+from constellation import docker_util
+from constellation.util import LABEL_PREFIX
+
+# States that 'docker ps' (without --all) does not report
+STOPPED_STATES = ("created", "exited", "dead")
+
+
+class Inventory:
+    """A snapshot of the docker objects belonging to a constellation.
+
+    Rather than probing docker once per container, network and volume,
+    this fetches everything with one filtered list call each, and
+    answers existence and status queries from that.  The snapshot is
+    refetched on the next query after anything is created, stopped or
+    removed through constellation (see docker_util.mark_changed).
+    Containers are found by constellation's prefix label, and also by
+    exact name for any names given in `containers` and by prefix for
+    any given in `replicas`, so that containers (and randomly named
+    service replicas) created before we labelled them are still seen.
+
+    Containers returned from here are built from the list response
+    rather than a full inspect; call reload() on them if you need
+    more than the name, id, status and labels.
+    """
+
+    def __init__(
+        self, prefix, networks=(), volumes=(), containers=(), replicas=()
+    ):
+        self.prefix = prefix
+        self.container_names = list(containers)
+        self.replica_prefixes = list(replicas)
+        self.network_names = list(networks)
+        self.volume_names = list(volumes)
+        self._generation = None
+
+    def refresh(self):
+        client = docker_util.get_client()
+        filters = {"label": f"{LABEL_PREFIX}={self.prefix}"}
+        containers = client.api.containers(all=True, filters=filters)
+        self._containers = {}
+        for x in containers:
+            for name in x["Names"]:
+                self._containers[name.lstrip("/")] = x
+        if self.container_names or self.replica_prefixes:
+            # The name filter is a regular expression, so anchor it,
+            # and check for matches ourselves too.
+            names = [f"^/{re.escape(x)}$" for x in self.container_names] + [
+                f"^/{re.escape(x)}" for x in self.replica_prefixes
+            ]
+            filters = {"name": names}
+            for x in client.api.containers(all=True, filters=filters):
+                for name in (y.lstrip("/") for y in x["Names"]):
+                    if self._wanted(name):
+                        self._containers.setdefault(name, x)
+
+        self._networks = set()
+        if self.network_names:
+            networks = client.api.networks(names=self.network_names)
+            self._networks = {x["Name"] for x in networks}
+
+        self._volumes = set()
+        if self.volume_names:
+            filters = {"name": self.volume_names}
+            volumes = client.api.volumes(filters=filters)["Volumes"] or []
+            self._volumes = {x["Name"] for x in volumes}
+
+        self._generation = docker_util.generation()
+
+    def _wanted(self, name):
+        return name in self.container_names or any(
+            name.startswith(x) for x in self.replica_prefixes
+        )
+
+    def _ensure_fresh(self):
+        if self._generation != docker_util.generation():
+            self.refresh()
+
+    def network_exists(self, name):
+        self._ensure_fresh()
+        return name in self._networks
+
+    def volume_exists(self, name):
+        self._ensure_fresh()
+        return name in self._volumes
+
+    def container_exists(self, name):
+        self._ensure_fresh()
+        return name in self._containers
+
+    def container_status(self, name):
+        self._ensure_fresh()
+        x = self._containers.get(name)
+        return x["State"] if x else "missing"
+
+    def get_container(self, name):
+        self._ensure_fresh()
+        x = self._containers.get(name)
+        return self._model(name, x) if x else None
+
+    def containers_labelled(self, labels, stopped=False):
+        self._ensure_fresh()
+        return [
+            self._model(name, x)
+            for name, x in self._containers.items()
+            if labels.items() <= (x.get("Labels") or {}).items()
+            and (stopped or x["State"] not in STOPPED_STATES)
+        ]
+
+    def containers_matching(self, prefix, stopped=False):
+        """Containers whose names start with `prefix`.
+
+        Only those found by label or named in `containers` or
+        `replicas` are known to us.
+        """
+        self._ensure_fresh()
+        return [
+            self._model(name, x)
+            for name, x in self._containers.items()
+            if name.startswith(prefix)
+            and (stopped or x["State"] not in STOPPED_STATES)
+        ]
+
+    def _model(self, name, attrs):
+        attrs = copy.deepcopy(attrs)
+        # Fill in the bits of the inspect response that docker-py
+        # needs for the name and labels properties.
+        attrs["Name"] = f"/{name}"
+        attrs["Config"] = {"Labels": attrs.get("Labels")}
+        client = docker_util.get_client()
+        return client.containers.prepare_model(attrs)
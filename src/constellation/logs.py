@@ -0,0 +1,133 @@
+import contextlib
+import contextvars
+import queue
+import threading
+from dataclasses import dataclass
+
+import docker
+
+# Marks the end of one container's logs on the shared queue
+_DONE = object()
+
+
+@dataclass
+class LogLine:
+    name: str
+    timestamp: str
+    text: str
+
+    def __str__(self):
+        return f"{self.name} | {self.timestamp} {self.text}"
+
+
+def split_lines(chunks):
+    """Reassemble lines from a stream of byte chunks.
+
+    Docker frames do not necessarily end on line boundaries, so we
+    hold on to any partial line until the rest of it arrives.
+    """
+    partial = b""
+    for chunk in chunks:
+        partial += chunk
+        *lines, partial = partial.split(b"\n")
+        yield from lines
+    if partial:
+        yield partial
+
+
+def parse_line(name, line):
+    # With timestamps=True docker prefixes each line with an RFC3339
+    # timestamp and a single space.
+    text = line.decode("UTF-8", errors="replace").rstrip("\r")
+    timestamp, _, text = text.partition(" ")
+    return LogLine(name, timestamp, text)
+
+
+class LogFollower:
+    """Stream logs from many containers at once.
+
+    Each container is read on its own thread, and lines are passed
+    through a queue of at most `queue_size` lines; a container that
+    logs faster than the reader consumes blocks rather than using
+    more memory.  Iterate over the follower (or call lines()) to
+    receive LogLine objects in the order they arrive.  Without
+    `follow`, iteration ends once every container's existing logs
+    have been read.
+    """
+
+    def __init__(self, containers, follow=True, since=None, queue_size=1000):
+        self.containers = containers
+        self.follow = follow
+        self.since = since
+        self._queue = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._streams = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for name, container in self.containers.items():
+            ctx = contextvars.copy_context()
+            t = threading.Thread(
+                target=ctx.run,
+                args=(self._follow, name, container),
+                daemon=True,
+            )
+            t.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            streams = list(self._streams)
+        for stream in streams:
+            # Unblocks any thread waiting on a followed container that
+            # is not currently logging.
+            with contextlib.suppress(Exception):
+                stream.close()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            with contextlib.suppress(queue.Full):
+                self._queue.put(item, timeout=0.1)
+                return True
+        return False
+
+    def _follow(self, name, container):
+        try:
+            stream = container.logs(
+                stream=True,
+                follow=self.follow,
+                timestamps=True,
+                since=self.since,
+            )
+            with self._lock:
+                self._streams.append(stream)
+            for line in split_lines(stream):
+                if not self._put(parse_line(name, line)):
+                    return
+        except docker.errors.APIError:
+            # The container went away; nothing more to read.
+            pass
+        except Exception:
+            # Closing the stream from stop() surfaces here as an error
+            # from the underlying connection.
+            if not self._stopped.is_set():
+                raise
+        finally:
+            self._put(_DONE)
+
+    def lines(self):
+        self.start()
+        remaining = len(self.containers)
+        try:
+            while remaining > 0:
+                item = self._queue.get()
+                if item is _DONE:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            self.stop()
+
+    def __iter__(self):
+        return self.lines()
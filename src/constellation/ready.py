@@ -0,0 +1,90 @@
+import socket
+import time
+
+import requests
+
+from constellation import docker_util
+
+
+class TcpProbe:
+    """Ready once something accepts connections on `port`.
+
+    Connects to the container's address on the constellation network
+    unless `host` is given (e.g., "localhost" with a published port).
+    """
+
+    def __init__(self, port, host=None):
+        self.port = port
+        self.host = host
+
+    def __call__(self, _container, address):
+        try:
+            with socket.create_connection(
+                (self.host or address, self.port), timeout=1
+            ):
+                return True
+        except OSError:
+            return False
+
+
+class HttpProbe:
+    """Ready once a GET of `path` returns a non-error status."""
+
+    def __init__(self, path="/", port=80, host=None):
+        self.path = path
+        self.port = port
+        self.host = host
+
+    def __call__(self, _container, address):
+        url = f"http://{self.host or address}:{self.port}{self.path}"
+        try:
+            r = requests.get(url, timeout=1)
+        except requests.exceptions.RequestException:
+            return False
+        # Ignore "magic number" 400 here for non-error HTTP codes
+        return r.status_code < 400  # noqa: PLR2004
+
+
+class ExecProbe:
+    """Ready once `args` can be run in the container successfully."""
+
+    def __init__(self, args):
+        self.args = args
+
+    def __call__(self, container, _address):
+        return container.exec_run(self.args).exit_code == 0
+
+
+def container_address(container, network):
+    networks = container.attrs["NetworkSettings"]["Networks"]
+    return networks[network]["IPAddress"]
+
+
+def wait_ready(container, probe, network, timeout, poll=0.5):
+    """Wait for a container to be ready to use.
+
+    If a probe is given, it is retried every `poll` seconds; otherwise
+    we wait for the container's docker healthcheck, if it has one.
+    Errors as soon as the container stops, or after `timeout` seconds.
+    """
+    if probe is None:
+        container.reload()
+        if "Health" in container.attrs["State"]:
+            docker_util.containers_wait_healthy([container], timeout)
+        return
+
+    until = time.monotonic() + timeout
+    while True:
+        container.reload()
+        if container.status != "running":
+            msg = (
+                f"container '{container.name}' stopped ({container.status}) "
+                "while waiting for it to be ready"
+            )
+            raise Exception(msg)
+        if probe(container, container_address(container, network)):
+            return
+        if time.monotonic() > until:
+            msg = f"container '{container.name}' was not ready in time"
+            raise Exception(msg)
+        time.sleep(poll)
@@ -0,0 +1,202 @@
+import contextlib
+import contextvars
+import math
+import queue
+import threading
+import time
+from collections import deque
+
+import docker
+
+# Cumulative values, which we report as rates
+COUNTERS = ("net_rx", "net_tx", "block_read", "block_write")
+
+# Marks the end of one container's stats on the shared queue
+_DONE = object()
+
+
+# Helpers for interpreting samples from the docker stats API; see
+# https://docs.docker.com/engine/api/v1.43/#tag/Container/operation/ContainerStats
+# for the calculations used by 'docker stats'.
+def cpu_percent(sample):
+    """Percentage of one cpu used, so can exceed 100 on multicore hosts."""
+    cpu = sample["cpu_stats"]
+    precpu = sample.get("precpu_stats") or {}
+    cpu_delta = cpu["cpu_usage"]["total_usage"] - precpu.get(
+        "cpu_usage", {}
+    ).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get(
+        "system_cpu_usage", 0
+    )
+    ncpu = cpu.get("online_cpus") or len(
+        cpu["cpu_usage"].get("percpu_usage") or [None]
+    )
+    if system_delta <= 0 or cpu_delta < 0:
+        return 0.0
+    return cpu_delta / system_delta * ncpu * 100
+
+
+def memory_usage(sample):
+    """Memory used in bytes, excluding the page cache."""
+    memory = sample.get("memory_stats") or {}
+    stats = memory.get("stats") or {}
+    cache = stats.get("inactive_file", stats.get("cache", 0))
+    return max(memory.get("usage", 0) - cache, 0)
+
+
+def memory_percent(sample):
+    limit = (sample.get("memory_stats") or {}).get("limit")
+    if not limit:
+        return 0.0
+    return memory_usage(sample) / limit * 100
+
+
+def network_bytes(sample):
+    networks = (sample.get("networks") or {}).values()
+    rx = sum(x.get("rx_bytes", 0) for x in networks)
+    tx = sum(x.get("tx_bytes", 0) for x in networks)
+    return rx, tx
+
+
+def block_bytes(sample):
+    blkio = sample.get("blkio_stats") or {}
+    entries = blkio.get("io_service_bytes_recursive") or []
+    read = sum(x["value"] for x in entries if x["op"].lower() == "read")
+    write = sum(x["value"] for x in entries if x["op"].lower() == "write")
+    return read, write
+
+
+def sample_metrics(sample, now=None):
+    """Reduce a stats sample to the metrics we keep."""
+    rx, tx = network_bytes(sample)
+    read, write = block_bytes(sample)
+    return {
+        "time": time.monotonic() if now is None else now,
+        "cpu": cpu_percent(sample),
+        "memory": memory_usage(sample),
+        "net_rx": rx,
+        "net_tx": tx,
+        "block_read": read,
+        "block_write": write,
+    }
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, with q between 0 and 100."""
+    xs = sorted(values)
+    return xs[max(0, math.ceil(q / 100 * len(xs)) - 1)]
+
+
+def summarise(history):
+    """Summarise a sequence of metrics, as from sample_metrics.
+
+    cpu is in percent of one cpu and memory in bytes; network and
+    block io are rates in bytes per second between samples, as the
+    underlying values are cumulative counters.
+    """
+    history = list(history)
+    series = {
+        "cpu": [x["cpu"] for x in history],
+        "memory": [x["memory"] for x in history],
+    }
+    for key in COUNTERS:
+        series[key] = [
+            (b[key] - a[key]) / (b["time"] - a["time"])
+            for a, b in zip(history, history[1:])
+            if b["time"] > a["time"]
+        ]
+    return {
+        key: {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": max(values),
+        }
+        for key, values in series.items()
+        if values
+    }
+
+
+class StatsCollector:
+    """Follow the docker stats streams for many containers at once.
+
+    Each container is followed on its own thread, and the last
+    `history` samples (docker sends one a second) are kept for each.
+    Use as a context manager, or call start() and stop().  Following
+    threads finish once they next receive a sample after stop().
+    """
+
+    def __init__(self, containers, history=120, queue_size=1000):
+        self.containers = containers
+        self.history = {name: deque(maxlen=history) for name in containers}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for name, container in self.containers.items():
+            ctx = contextvars.copy_context()
+            t = threading.Thread(
+                target=ctx.run,
+                args=(self._follow, name, container),
+                daemon=True,
+            )
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            with contextlib.suppress(queue.Full):
+                self._queue.put(item, timeout=0.1)
+                return
+
+    def _follow(self, name, container):
+        try:
+            for sample in container.stats(decode=True, stream=True):
+                if self._stopped.is_set():
+                    return
+                metrics = sample_metrics(sample)
+                with self._lock:
+                    self.history[name].append(metrics)
+                # Readers that fall behind miss samples, rather than
+                # holding up collection.
+                with contextlib.suppress(queue.Full):
+                    self._queue.put_nowait((name, metrics))
+        except docker.errors.APIError:
+            # The container went away; nothing more to collect.
+            pass
+        finally:
+            self._put(_DONE)
+
+    def summary(self):
+        with self._lock:
+            history = {k: list(v) for k, v in self.history.items()}
+        return {k: summarise(v) for k, v in history.items()}
+
+    def stream(self):
+        """Yield (name, metrics) pairs as samples arrive.
+
+        Ends once every container's stats stream has ended (so at once
+        if there are no containers).
+        """
+        self.start()
+        remaining = len(self.containers)
+        try:
+            while remaining > 0:
+                item = self._queue.get()
+                if item is _DONE:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            self.stop()
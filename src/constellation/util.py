@@ -1,6 +1,21 @@
+import contextvars
+import hashlib
+import json
 import random
 import string
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# Labels applied to everything that constellation creates, so that we
+# can find our objects with server-side filters.
+LABEL_NAME = "constellation.name"
+LABEL_PREFIX = "constellation.prefix"
+LABEL_ROLE = "constellation.role"
+LABEL_REPLICA = "constellation.replica"
+LABEL_SPEC = "constellation.spec"
+LABEL_BUILD = "constellation.build"
 
 
 @dataclass
@@ -15,8 +30,18 @@ class ImageReference:
 
 @dataclass
 class BuildSpec:
-    # Path to the directory containing the Dockerfile
+    # Path to the build context, normally containing the Dockerfile
     path: str
+    # Path to the Dockerfile, if not "Dockerfile" within the context
+    dockerfile: Optional[str] = None
+    # Build arguments, by name
+    buildargs: Optional[Dict[str, str]] = None
+    # Stage to build, for multi-stage Dockerfiles
+    target: Optional[str] = None
+    # Images to use as cache sources (typically previously pushed)
+    cache_from: Optional[List[str]] = None
+    # Labels to apply to the built image
+    labels: Optional[Dict[str, str]] = None
 
 
 def tabulate(x):
@@ -32,3 +57,141 @@ def tabulate(x):
 def rand_str(n, prefix=""):
     s = "".join(random.choice(string.ascii_lowercase) for i in range(n))
     return prefix + s
+
+
+def constellation_labels(prefix, role, name=None, replica=None):
+    labels = {LABEL_PREFIX: prefix, LABEL_ROLE: role}
+    if name is not None:
+        labels[LABEL_NAME] = name
+    if replica is not None:
+        labels[LABEL_REPLICA] = str(replica)
+    return labels
+
+
+def spec_hash(spec):
+    """Stable hash of a json-serialisable description of something."""
+    txt = json.dumps(spec, sort_keys=True, default=str)
+    return hashlib.sha256(txt.encode("utf-8")).hexdigest()
+
+
+def label_filters(labels):
+    return [f"{k}={v}" for k, v in labels.items()]
+
+
+def dependency_waves(nodes):
+    """Group nodes into waves that can be run together.
+
+    Each node must have a `name` and a list of names in `depends_on`;
+    every node is placed in a later wave than all the nodes it
+    depends on.  Dependencies on names not found in `nodes` are
+    ignored, so that a subset of a larger graph can be scheduled.
+    Within a wave, nodes retain their original order.
+    """
+    names = {x.name for x in nodes}
+    done = set()
+    remaining = list(nodes)
+    waves = []
+    while remaining:
+        wave = [
+            x
+            for x in remaining
+            if all(d in done or d not in names for d in x.depends_on)
+        ]
+        if not wave:
+            cycle = ", ".join(x.name for x in remaining)
+            msg = f"Dependency cycle between: {cycle}"
+            raise Exception(msg)
+        waves.append(wave)
+        done.update(x.name for x in wave)
+        remaining = [x for x in remaining if x.name not in done]
+    return waves
+
+
+def run_parallel(fn, items, parallel=1):
+    """Apply `fn` to each of `items` using up to `parallel` threads.
+
+    Results are returned in the order of `items`.  All calls are
+    allowed to finish before the first error (in item order) is
+    re-raised, so that nothing is left running in the background.
+    Each call runs in a copy of the caller's context, so context
+    variables (such as the docker client in use) are carried over.
+    """
+    items = list(items)
+    if parallel <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=min(parallel, len(items))) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, fn, x) for x in items
+        ]
+        wait(futures)
+    return [f.result() for f in futures]
+
+
+def run_graph(fn, nodes, parallel=1):
+    """Apply `fn` to each node once it has been applied to its dependencies.
+
+    Nodes are as for dependency_waves.  Rather than waiting for a
+    whole wave to finish, each node is started as soon as everything
+    it depends on has finished, using up to `parallel` threads.  After
+    an error no new nodes are started; once the running ones finish
+    the first error is re-raised.
+    """
+    waves = dependency_waves(nodes)
+    if parallel <= 1:
+        for wave in waves:
+            for x in wave:
+                fn(x)
+        return
+
+    names = {x.name for x in nodes}
+    remaining = list(nodes)
+    done = set()
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        while remaining or running:
+            if error is None:
+                ready = [
+                    x
+                    for x in remaining
+                    if all(d in done or d not in names for d in x.depends_on)
+                ]
+                for x in ready:
+                    ctx = contextvars.copy_context()
+                    running[pool.submit(ctx.run, fn, x)] = x
+                    remaining.remove(x)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in finished:
+                x = running.pop(f)
+                if f.exception() is None:
+                    done.add(x.name)
+                elif error is None:
+                    error = f.exception()
+    if error is not None:
+        raise error
+
+
+class TailBuffer:
+    """Keep (roughly) the last `size` bytes of a stream.
+
+    Whole chunks are held, and dropped once enough later data has
+    arrived, so memory use is bounded by `size` plus one chunk.
+    """
+
+    def __init__(self, size):
+        self.size = size or 0
+        self._chunks = deque()
+        self._length = 0
+
+    def append(self, data):
+        if not self.size or not data:
+            return
+        self._chunks.append(data)
+        self._length += len(data)
+        while self._length - len(self._chunks[0]) >= self.size:
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return b"".join(self._chunks)[-self.size :] if self.size else b""
@@ -0,0 +1,151 @@
+import io
+import threading
+from contextlib import redirect_stdout
+from unittest import mock
+
+import docker
+
+from constellation import docker_util
+from constellation.autoscale import AutoscalePolicy, Autoscaler
+
+
+def autoscaler(policy, replicas=2):
+    constellation = mock.Mock(prefix="prefix", client=None)
+    service = constellation.service.return_value
+    service.name = "worker"
+    service.get.return_value = [mock.Mock() for _ in range(replicas)]
+    return Autoscaler(constellation, "worker", policy)
+
+
+def test_decide_waits_for_full_window():
+    obj = autoscaler(AutoscalePolicy(1, 5, window=3))
+    obj.samples.extend([(95, 0), (95, 0)])
+    assert obj.decide(2, 0) == 2
+    obj.samples.append((95, 0))
+    assert obj.decide(2, 0) == 3
+
+
+def test_decide_scales_within_bounds():
+    obj = autoscaler(AutoscalePolicy(1, 3, window=2, step=2))
+    obj.samples.extend([(95, 0), (90, 0)])
+    assert obj.decide(2, 0) == 3
+    obj.samples.clear()
+    obj.samples.extend([(5, 0), (10, 0)])
+    assert obj.decide(2, 0) == 1
+    # Out of bounds, we correct straight away
+    assert obj.decide(0, 0) == 1
+    assert obj.decide(7, 0) == 3
+
+
+def test_decide_uses_smoothed_samples_and_memory():
+    policy = AutoscalePolicy(1, 5, window=2, memory_high=80, memory_low=30)
+    obj = autoscaler(policy)
+    obj.samples.extend([(100, 10), (0, 10)])
+    assert obj.decide(2, 0) == 2
+    obj.samples.extend([(50, 90), (50, 90)])
+    assert obj.decide(2, 0) == 3
+    obj.samples.extend([(5, 50), (5, 50)])
+    assert obj.decide(2, 0) == 2
+    obj.samples.extend([(5, 10), (5, 10)])
+    assert obj.decide(2, 0) == 1
+
+
+def test_decide_respects_cooldowns():
+    policy = AutoscalePolicy(1, 5, window=1, cooldown_up=10, cooldown_down=60)
+    obj = autoscaler(policy)
+    obj.last_change = 100
+    obj.samples.append((95, 0))
+    assert obj.decide(2, 105) == 2
+    assert obj.decide(2, 110) == 3
+    obj.samples.append((5, 0))
+    assert obj.decide(2, 150) == 2
+    assert obj.decide(2, 160) == 1
+
+
+def test_step_scales_and_resets_window():
+    obj = autoscaler(AutoscalePolicy(1, 5, window=1))
+    obj.sample = mock.Mock(return_value=(95, 10))
+    assert obj.step(now=0) == 3
+    obj.constellation.scale.assert_called_once_with("worker", 3)
+    assert obj.last_change == 0
+    assert len(obj.samples) == 0
+
+
+def test_sample_averages_over_replicas():
+    obj = autoscaler(AutoscalePolicy(1, 5))
+    for x, total in zip(obj.service.get.return_value, [150, 250]):
+        x.stats.return_value = {
+            "cpu_stats": {
+                "cpu_usage": {"total_usage": total},
+                "system_cpu_usage": 1000,
+                "online_cpus": 1,
+            },
+            "precpu_stats": {
+                "cpu_usage": {"total_usage": 100},
+                "system_cpu_usage": 500,
+            },
+            "memory_stats": {"usage": 50, "limit": 100},
+        }
+    cpu, memory = obj.sample()
+    assert cpu == 20
+    assert memory == 50
+
+
+def test_sample_skips_replicas_that_have_gone():
+    obj = autoscaler(AutoscalePolicy(1, 5), replicas=3)
+    first, *rest = obj.service.get.return_value
+    first.stats.return_value = {
+        "cpu_stats": {
+            "cpu_usage": {"total_usage": 150},
+            "system_cpu_usage": 1000,
+            "online_cpus": 1,
+        },
+        "precpu_stats": {
+            "cpu_usage": {"total_usage": 100},
+            "system_cpu_usage": 500,
+        },
+        "memory_stats": {"usage": 50, "limit": 100},
+    }
+    for x in rest:
+        x.stats.side_effect = docker.errors.NotFound("gone")
+    assert obj.sample() == (10, 50)
+    first.stats.side_effect = docker.errors.APIError("conflict")
+    assert obj.sample() is None
+
+
+def test_run_carries_on_after_failed_step():
+    obj = autoscaler(AutoscalePolicy(1, 5, interval=0))
+    stop = threading.Event()
+    calls = []
+
+    def step():
+        calls.append(1)
+        if len(calls) == 1:
+            msg = "some error"
+            raise Exception(msg)
+        stop.set()
+
+    obj.step = step
+    f = io.StringIO()
+    with redirect_stdout(f):
+        obj.run(stop)
+    assert len(calls) == 2
+    assert "Autoscaling 'worker' failed: some error" in f.getvalue()
+
+
+def test_autoscaler_uses_constellation_client():
+    obj = autoscaler(AutoscalePolicy(1, 5))
+    obj.constellation.client = mock.Mock()
+    clients = []
+
+    def get(_prefix):
+        clients.append(docker_util.get_client())
+        replicas = [mock.Mock() for _ in range(3)]
+        for x in replicas:
+            x.stats.side_effect = docker.errors.NotFound("gone")
+        return replicas
+
+    obj.service.get.side_effect = get
+    assert obj.step(now=0) == 3
+    # Once to sample the replicas, and once to count them
+    assert clients == [obj.constellation.client] * 2
@@ -1,5 +1,8 @@
 import io
+import re
+import time
 from contextlib import redirect_stdout
+from unittest import mock
 
 import docker
 import pytest
@@ -17,9 +20,11 @@ from constellation.constellation import (
     ConstellationVolumeMount,
     container_ports,
     docker_util,
+    image_key,
     port_config,
     vault,
 )
+from constellation.ready import HttpProbe
 from constellation.util import BuildSpec, ImageReference, rand_str
 
 
@@ -626,8 +631,19 @@ def test_constellation_can_set_labels():
     )
     obj.start()
 
-    assert container.get("prefix").labels == {}
-    assert container_label.get("prefix").labels == labels
+    assert container.get("prefix").labels == {
+        "constellation.prefix": "prefix",
+        "constellation.role": "alpine",
+        "constellation.name": "mything",
+        "constellation.spec": mock.ANY,
+    }
+    assert container_label.get("prefix").labels == {
+        "constellation.prefix": "prefix",
+        "constellation.role": "alpine2",
+        "constellation.name": "mything",
+        "constellation.spec": mock.ANY,
+        **labels,
+    }
 
     obj.destroy()
 
@@ -649,3 +665,634 @@ CMD ["echo", "Hello, World"]
     assert "Hello, World\n" == log
 
     obj.destroy()
+
+
+def test_container_collection_validates_dependencies():
+    ref = "library/redis:5.0"
+    x = ConstellationContainer("server", ref, depends_on=["db"])
+    with pytest.raises(Exception, match="'server' depends on undefined 'db'"):
+        ConstellationContainerCollection([x])
+
+    y = ConstellationContainer("db", ref, depends_on=["server"])
+    with pytest.raises(Exception, match="Dependency cycle"):
+        ConstellationContainerCollection([x, y])
+
+
+def test_start_respects_dependencies_in_parallel():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref_server = ImageReference("library", "nginx", "latest")
+    ref_client = ImageReference("library", "alpine", "latest")
+    arg_client = ["sleep", "1000"]
+
+    def cfg_client(container, _data):
+        res = container.exec_run(["apk", "add", "--no-cache", "curl"])
+        assert res.exit_code == 0
+        docker_util.exec_safely(container, ["curl", "http://server"])
+
+    server = ConstellationContainer("server", ref_server)
+    client = ConstellationContainer(
+        "client",
+        ref_client,
+        arg_client,
+        configure=cfg_client,
+        depends_on=["server"],
+    )
+    other = ConstellationService(
+        "other", ref_client, 2, args=arg_client, depends_on=["server"]
+    )
+
+    obj = Constellation(name, prefix, [client, other, server], network, None)
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        obj.start(parallel=4)
+    lines = [x for x in f.getvalue().split("\n") if x.startswith("Starting")]
+    assert lines[0] == "Starting server (library/nginx:latest)"
+
+    assert obj.containers.find("client").exists(prefix)
+    assert len(other.get(prefix)) == 2
+
+    obj.destroy()
+
+
+def test_image_key_identifies_shared_images():
+    ref = ImageReference("library", "redis", "5.0")
+    assert image_key(ref) == image_key("library/redis:5.0")
+    assert image_key(BuildSpec("/a")) == image_key(BuildSpec("/a"))
+    assert image_key(BuildSpec("/a")) != image_key(BuildSpec("/b"))
+
+
+def test_prepare_images_pulls_shared_images_once():
+    ref_redis = ImageReference("library", "redis", "5.0")
+    ref_alpine = ImageReference("library", "alpine", "latest")
+    x = ConstellationContainer("server", ref_redis)
+    y = ConstellationService("worker", ref_redis, 2)
+    z = ConstellationContainer("client", ref_alpine)
+    obj = ConstellationContainerCollection([x, y, z])
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        timings = obj.prepare_images(pull=True, parallel=2)
+
+    s = f.getvalue()
+    assert s.count("Pulling docker image") == 2
+    assert "Pulling docker image server, worker (library/redis:5.0)" in s
+    assert set(timings.keys()) == {str(ref_redis), str(ref_alpine)}
+    assert x.image_id == str(ref_redis)
+    assert y.image_id == str(ref_redis)
+    assert z.image_id == str(ref_alpine)
+
+
+def test_prepare_images_builds_concurrently():
+    specs = [BuildSpec("/a", target="x"), BuildSpec("/b"), BuildSpec("/a")]
+    containers = [
+        ConstellationContainer(f"c{i}", spec) for i, spec in enumerate(specs)
+    ]
+    obj = ConstellationContainerCollection(containers)
+    running = []
+    overlapped = []
+
+    def build(name, _spec, log):
+        running.append(name)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.2)
+        log(name, "done")
+        running.remove(name)
+        return f"sha256:{name}"
+
+    log = mock.Mock()
+    f = io.StringIO()
+    with mock.patch(
+        "constellation.docker_util.image_build", side_effect=build
+    ), redirect_stdout(f):
+        timings = obj.prepare_images(pull=False, parallel=3, log=log)
+    assert any(overlapped)
+    assert all(x >= 0.2 for x in timings.values())
+    s = f.getvalue()
+    for name in ["c0", "c1", "c2"]:
+        assert re.search(f"`-> {name} ready in 0\\.\\ds", s)
+    assert [x.image_id for x in containers] == [
+        "sha256:c0",
+        "sha256:c1",
+        "sha256:c2",
+    ]
+    assert sorted(x.args for x in log.call_args_list) == [
+        ("c0", "done"),
+        ("c1", "done"),
+        ("c2", "done"),
+    ]
+
+
+def test_stop_in_parallel_with_deadline():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    # sleep ignores SIGTERM when run as pid 1, so needs killing
+    args = ["sleep", "1000"]
+
+    server = ConstellationContainer("server", ref, args)
+    client = ConstellationContainer("client", ref, args, depends_on=["server"])
+    workers = ConstellationService("worker", ref, 3, args=args)
+
+    obj = Constellation(name, prefix, [server, client, workers], network, None)
+    obj.start(parallel=4)
+
+    f = io.StringIO()
+    t0 = time.monotonic()
+    with redirect_stdout(f):
+        obj.stop(parallel=4, timeout=30, deadline=2)
+    elapsed = time.monotonic() - t0
+
+    assert elapsed < 10
+    s = f.getvalue().strip().split("\n")
+    assert s.index("Stop 'client'") < s.index("Killing 'server'")
+    assert not server.exists(prefix)
+    assert not client.exists(prefix)
+    assert not workers.exists(prefix)
+
+    obj.destroy()
+
+
+def test_spec_hash_with_mixed_port_keys():
+    x = ConstellationContainer(
+        "server", "library/redis:5.0", ports=[80, ("53/udp", 5353)]
+    )
+    assert x.ports_config == {80: 80, "53/udp": 5353}
+    network = ConstellationNetwork("thenw")
+    with mock.patch.object(docker_util, "image_id", return_value="sha256:abc"):
+        a = x.spec_hash("prefix", network, None)
+        x.ports_config = {80: 8080, "53/udp": 5353}
+        b = x.spec_hash("prefix", network, None)
+    assert a != b
+
+
+def test_constellation_uses_its_own_client():
+    client = mock.MagicMock()
+    x = ConstellationContainer("server", "library/redis:5.0")
+    obj = Constellation("mything", "prefix", [x], "thenw", None, client=client)
+    f = io.StringIO()
+    with redirect_stdout(f):
+        obj.status()
+    client.api.networks.assert_called_once_with(names=["thenw"])
+    # By label, then by name for containers that predate labels
+    assert client.api.containers.call_args_list == [
+        mock.call(all=True, filters={"label": "constellation.prefix=prefix"}),
+        mock.call(all=True, filters={"name": ["^/prefix\\-server$"]}),
+    ]
+
+
+def test_services_are_found_by_label_not_name():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    volumes = {"data": constellation_rand_str()}
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    web = ConstellationService("web", ref, 2, args=args)
+    admin = ConstellationService("web-admin", ref, 1, args=args)
+
+    obj = Constellation(name, prefix, [web, admin], network, volumes)
+    obj.start(parallel=2)
+
+    assert len(web.get(prefix)) == 2
+    assert len(admin.get(prefix)) == 1
+    x = web.get(prefix)[0]
+    assert x.labels["constellation.role"] == "web"
+    assert x.labels["constellation.name"] == name
+    assert x.labels["constellation.replica"] in {"1", "2"}
+
+    cl = docker.client.from_env()
+    vol = cl.volumes.get(volumes["data"])
+    assert vol.attrs["Labels"]["constellation.role"] == "data"
+    assert vol.attrs["Labels"]["constellation.prefix"] == prefix
+
+    obj.destroy()
+
+
+def test_start_waits_for_readiness():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref_server = ImageReference("library", "nginx", "latest")
+    ref_client = ImageReference("library", "alpine", "latest")
+
+    # nginx takes a moment to come up; the client's configure will
+    # fail unless it runs only once the server is ready.
+    server = ConstellationContainer(
+        "server",
+        ref_server,
+        entrypoint=["sh", "-c", "sleep 2 && nginx -g 'daemon off;'"],
+        ready=HttpProbe("/"),
+        ready_timeout=30,
+    )
+    db = ConstellationContainer(
+        "db",
+        ref_client,
+        ["sleep", "1000"],
+        healthcheck={"test": ["CMD", "true"], "interval": 100_000_000},
+    )
+
+    def cfg_client(container, _data):
+        args = ["wget", "-q", "-O-", "http://server"]
+        docker_util.exec_safely(container, args)
+
+    client = ConstellationContainer(
+        "client",
+        ref_client,
+        ["sleep", "1000"],
+        configure=cfg_client,
+        depends_on=["server", "db"],
+    )
+
+    obj = Constellation(name, prefix, [server, db, client], network, None)
+    obj.start(parallel=3, wait_ready=True)
+    assert db.get(prefix).health == "healthy"
+    obj.destroy()
+
+
+def test_apply_only_recreates_changed_containers():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    server = ConstellationContainer("server", ref, args)
+    client = ConstellationContainer("client", ref, args)
+    workers = ConstellationService("worker", ref, 2, args=args)
+
+    obj = Constellation(name, prefix, [server, client, workers], network, None)
+    assert obj.apply() == ["server", "client", "worker"]
+    id_server = server.get(prefix).id
+    id_client = client.get(prefix).id
+    id_workers = {x.id for x in workers.get(prefix)}
+
+    assert obj.apply() == []
+
+    client.environment = {"A": "1"}
+    assert obj.apply() == ["client"]
+    assert server.get(prefix).id == id_server
+    assert client.get(prefix).id != id_client
+    assert {x.id for x in workers.get(prefix)} == id_workers
+
+    workers.get(prefix)[0].kill()
+    assert obj.apply() == ["worker"]
+    assert len(workers.get(prefix)) == 2
+
+    obj.destroy()
+
+
+def test_rolling_update_order():
+    events = []
+    old = [
+        mock.Mock(id=f"old{i}", labels={"constellation.replica": str(i)})
+        for i in range(1, 4)
+    ]
+    for x in old:
+        x.remove.side_effect = lambda x=x: events.append(f"retire {x.id}")
+
+    def start_replicas(indices, *_args):
+        events.extend(f"start {i}" for i in indices)
+
+    svc = ConstellationService("worker", "library/alpine:latest", 3)
+    svc.get = mock.Mock(return_value=old)
+    svc._start_replicas = start_replicas
+    with mock.patch.object(docker_util, "container_stop"):
+        svc.rolling_update("prefix", None, None, batch_size=2)
+        assert events == [
+            "start 1",
+            "start 2",
+            "retire old1",
+            "retire old2",
+            "start 3",
+            "retire old3",
+        ]
+        old[0].rename.assert_called_once()
+        events.clear()
+        svc.rolling_update("prefix", None, None, max_unavailable=1)
+        assert events == [
+            "retire old1",
+            "start 1",
+            "retire old2",
+            "start 2",
+            "retire old3",
+            "start 3",
+        ]
+
+
+def test_rolling_update_keeps_current_scale():
+    events = []
+    old = [
+        mock.Mock(id=f"old{i}", labels={"constellation.replica": str(i)})
+        for i in range(1, 5)
+    ]
+    for x in old:
+        x.remove.side_effect = lambda x=x: events.append(f"retire {x.id}")
+
+    def start_replicas(indices, *_args):
+        events.extend(f"start {i}" for i in indices)
+
+    # Scaled in place (perhaps by another process) from 2 to 4
+    svc = ConstellationService("worker", "library/alpine:latest", 2)
+    svc.get = mock.Mock(return_value=old)
+    svc._start_replicas = start_replicas
+    with mock.patch.object(docker_util, "container_stop"):
+        svc.rolling_update("prefix", None, None, batch_size=2)
+    assert events == [
+        "start 1",
+        "start 2",
+        "retire old1",
+        "retire old2",
+        "start 3",
+        "start 4",
+        "retire old3",
+        "retire old4",
+    ]
+
+
+def test_service_up_to_date_ignores_scale():
+    svc = ConstellationService("worker", "library/alpine:latest", 2)
+    replicas = [
+        mock.Mock(status="running", labels={"constellation.spec": "abc"})
+        for _ in range(4)
+    ]
+    svc.get = mock.Mock(return_value=replicas)
+    with mock.patch.object(svc.base, "spec_hash", return_value="abc"):
+        assert svc.up_to_date("prefix", None, None, None, None)
+        replicas[0].status = "exited"
+        assert not svc.up_to_date("prefix", None, None, None, None)
+        svc.get.return_value = []
+        assert not svc.up_to_date("prefix", None, None, None, None)
+
+
+def test_service_exists_if_only_stopped_replicas():
+    svc = ConstellationService("worker", "library/alpine:latest", 2)
+    svc.get = mock.Mock(return_value=[mock.Mock(status="exited")])
+    assert svc.exists("prefix")
+    svc.get.assert_called_once_with("prefix", True, None)
+    svc.get.return_value = []
+    assert not svc.exists("prefix")
+
+
+def test_unindexed_replicas_are_replaced():
+    events = []
+    old = [mock.Mock(id=f"old{i}", labels={}) for i in range(3)]
+    for x in old:
+        x.status = "running"
+        x.remove.side_effect = lambda x=x: events.append(f"retire {x.id}")
+
+    def start_replicas(indices, *_args):
+        events.extend(f"start {i}" for i in indices)
+
+    # Replicas from before they were labelled, with random names
+    svc = ConstellationService("worker", "library/alpine:latest", 2)
+    svc.get = mock.Mock(return_value=old)
+    svc._start_replicas = start_replicas
+    f = io.StringIO()
+    with mock.patch.object(docker_util, "container_stop"), redirect_stdout(f):
+        svc.rolling_update("prefix", None, None, batch_size=3)
+        assert events == [
+            "start 1",
+            "start 2",
+            "start 3",
+            "retire old0",
+            "retire old1",
+            "retire old2",
+        ]
+        events.clear()
+        svc.scale_to(2, "prefix", None, None)
+        assert events == [
+            "start 1",
+            "start 2",
+            "retire old0",
+            "retire old1",
+            "retire old2",
+        ]
+
+
+def test_rolling_update_rolls_back_failed_batch():
+    old = []
+    for i in range(1, 4):
+        x = mock.Mock(id=f"old{i}", labels={"constellation.replica": str(i)})
+        x.name = f"prefix-worker-{i}"
+        old.append(x)
+    new = {}
+
+    def start_replicas(indices, *_args):
+        if 3 in indices:
+            new.update({f"prefix-worker-{i}": mock.Mock() for i in indices})
+            msg = "not ready in time"
+            raise Exception(msg)
+
+    client = mock.Mock()
+    client.containers.get.side_effect = lambda name: new[name]
+    svc = ConstellationService("worker", "library/alpine:latest", 3)
+    svc.get = mock.Mock(return_value=old)
+    svc._start_replicas = start_replicas
+    f = io.StringIO()
+    with mock.patch.object(
+        docker_util, "container_stop"
+    ), docker_util.using_client(client), redirect_stdout(f):
+        with pytest.raises(Exception, match="not ready in time"):
+            svc.rolling_update("prefix", None, None, batch_size=2)
+    # The first batch completed
+    old[0].remove.assert_called_once()
+    old[1].remove.assert_called_once()
+    # The second was undone
+    new["prefix-worker-3"].remove.assert_called_once_with(force=True)
+    old[2].remove.assert_not_called()
+    assert old[2].rename.call_args_list[-1] == mock.call("prefix-worker-3")
+    assert "Rolling back update of worker" in f.getvalue()
+
+
+def test_rolling_update_replaces_replicas():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    workers = ConstellationService("worker", ref, 3, args=args)
+    obj = Constellation(name, prefix, [workers], network, None)
+    obj.start()
+    ids = {x.id for x in workers.get(prefix)}
+
+    workers.base.environment = workers.kwargs["environment"] = {"A": "1"}
+    obj.rolling_update("worker", batch_size=2)
+
+    replicas = workers.get(prefix, True)
+    assert len(replicas) == 3
+    assert not ids & {x.id for x in replicas}
+    assert all(x.status == "running" for x in replicas)
+    assert obj.apply() == []
+
+    with pytest.raises(Exception, match="'worker' is not a service"):
+        Constellation(
+            name, prefix, [ConstellationContainer("worker", ref)], network, None
+        ).rolling_update("worker")
+
+    obj.destroy()
+
+
+def test_scale_to_adds_and_removes_by_index():
+    def replica(i, status="running"):
+        x = mock.Mock(status=status, labels={"constellation.replica": str(i)})
+        x.remove.side_effect = lambda: events.append(f"retire {i}")
+        return x
+
+    events = []
+    svc = ConstellationService("worker", "library/alpine:latest", 3)
+    svc._start_replicas = lambda indices, *_args: events.extend(
+        f"start {i}" for i in indices
+    )
+    with mock.patch.object(docker_util, "container_stop"):
+        svc.get = mock.Mock(return_value=[replica(1), replica(3)])
+        svc.scale_to(4, "prefix", None, None)
+        assert events == ["start 2", "start 4"]
+        assert svc.scale == 4
+
+        events.clear()
+        svc.get = mock.Mock(
+            return_value=[replica(i) for i in range(1, 5)]
+            + [replica(5, "exited")]
+        )
+        svc.scale_to(2, "prefix", None, None)
+        assert events == ["retire 5", "retire 4", "retire 3"]
+        assert svc.scale == 2
+
+
+def test_scale_service_in_place():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    workers = ConstellationService("worker", ref, 2, args=args)
+    obj = Constellation(name, prefix, [workers], network, None)
+    obj.start()
+    names = sorted(x.name for x in workers.get(prefix))
+    assert names == [f"{prefix}-worker-1", f"{prefix}-worker-2"]
+    ids = {x.id for x in workers.get(prefix)}
+
+    obj.scale("worker", 4)
+    replicas = workers.get(prefix)
+    assert len(replicas) == 4
+    assert ids < {x.id for x in replicas}
+
+    obj.scale("worker", 1)
+    assert [x.name for x in workers.get(prefix, True)] == [f"{prefix}-worker-1"]
+
+    obj.destroy()
+
+
+def test_service_starts_replicas_from_one_template():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    workers = ConstellationService(
+        "worker", ref, 6, args=args, environment={"A": "1"}
+    )
+    obj = Constellation(name, prefix, [workers], network, None)
+    with mock.patch.object(
+        workers.base, "create_template", wraps=workers.base.create_template
+    ) as create_template:
+        obj.start(parallel=3)
+    assert create_template.call_count == 1
+
+    replicas = workers.get(prefix)
+    assert len(replicas) == 6
+    specs = {x.labels["constellation.spec"] for x in replicas}
+    assert len(specs) == 1
+    assert {x.labels["constellation.replica"] for x in replicas} == {
+        str(i) for i in range(1, 7)
+    }
+    for x in replicas:
+        assert "A=1" in x.attrs["Config"]["Env"]
+        aliases = x.attrs["NetworkSettings"]["Networks"][network]["Aliases"]
+        assert x.name[len(prefix) + 1 :] in aliases
+
+    obj.destroy()
+
+
+def test_constellation_stats():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    server = ConstellationContainer("server", ref, args)
+    workers = ConstellationService("worker", ref, 2, args=args)
+    obj = Constellation(name, prefix, [server, workers], network, None)
+    obj.start()
+
+    res = obj.stats(duration=3)
+    assert set(res.keys()) == {"server", "worker-1", "worker-2"}
+    assert res["server"]["memory"]["max"] > 0
+    assert set(res["server"]["cpu"].keys()) == {"p50", "p95", "max"}
+
+    stream = obj.stats_stream(containers=["worker"])
+    name, metrics = next(stream)
+    assert name in {"worker-1", "worker-2"}
+    assert "cpu" in metrics
+    stream.close()
+
+    obj.destroy()
+
+
+def test_constellation_logs():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sh", "-c", "echo hello; sleep 1000"]
+
+    server = ConstellationContainer("server", ref, args)
+    workers = ConstellationService("worker", ref, 2, args=args)
+    obj = Constellation(name, prefix, [server, workers], network, None)
+    obj.start()
+    time.sleep(1)
+
+    res = list(obj.logs(follow=False))
+    assert sorted(x.name for x in res) == ["server", "worker-1", "worker-2"]
+    assert all(x.text == "hello" for x in res)
+
+    lines = obj.logs(containers=["worker"])
+    seen = {next(lines).name, next(lines).name}
+    assert seen == {"worker-1", "worker-2"}
+    lines.close()
+
+    obj.destroy()
+
+
+def test_constellation_exec_all():
+    name = "mything"
+    prefix = constellation_rand_str()
+    network = "thenw"
+    ref = ImageReference("library", "alpine", "latest")
+    args = ["sleep", "1000"]
+
+    server = ConstellationContainer("server", ref, args)
+    workers = ConstellationService("worker", ref, 3, args=args)
+    obj = Constellation(name, prefix, [server, workers], network, None)
+    obj.start()
+
+    res = obj.exec_all(["hostname"], containers=["worker"])
+    assert set(res.keys()) == {"worker-1", "worker-2", "worker-3"}
+    assert all(x.ok for x in res.values())
+    assert len({x.output for x in res.values()}) == 3
+
+    with pytest.raises(Exception, match="in 4 of 4 containers"):
+        obj.exec_all(["false"])
+    res = obj.exec_all(["false"], check=False)
+    assert [x.exit_code for x in res.values()] == [1, 1, 1, 1]
+
+    obj.destroy()
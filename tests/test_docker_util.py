@@ -1,31 +1,61 @@
+import gzip
 import io
+import os
+import subprocess
+import tarfile
 import tempfile
+import time
 from contextlib import redirect_stdout
+from unittest import mock
 
 import docker
 import pytest
 
 from constellation.docker_util import (
+    ExecError,
+    archive_from_container,
+    build_fingerprint,
     bytes_from_container,
     container_exists,
+    container_hashes,
     container_remove_wait,
+    container_stop,
     container_wait_running,
+    containers_wait_healthy,
+    containers_wait_running,
+    directory_from_container,
     ensure_image,
     ensure_network,
     ensure_volume,
+    exec_all,
     exec_safely,
+    exec_stream,
     file_into_container,
+    files_into_container,
+    get_client,
     ignoring_missing,
+    image_build,
     image_exists,
     image_pull,
     network_exists,
+    path_into_container,
     remove_network,
     remove_volume,
     return_logs_and_remove,
+    set_default_client,
+    sha256,
+    simple_tar_string,
+    stream_from_container,
+    stream_logs_and_remove,
     string_from_container,
     string_into_container,
+    tar_info,
+    tar_stream,
+    using_client,
     volume_exists,
+    walk_filtered,
 )
+from constellation.util import BuildSpec, run_parallel
 
 
 def drop_image(ref):
@@ -146,6 +176,506 @@ def test_string_into_container_allows_bytes():
     container.kill()
 
 
+def test_simple_tar_string_is_built_in_memory():
+    with mock.patch("tempfile.mkstemp") as mkstemp:
+        tar = simple_tar_string("hello", "greeting", 0o600, 1000, 1001, 1234)
+    mkstemp.assert_not_called()
+    with tarfile.open(fileobj=tar) as t:
+        info = t.getmember("greeting")
+        assert info.mode == 0o600
+        assert (info.uid, info.gid) == (1000, 1001)
+        assert info.mtime == 1234
+        assert t.extractfile(info).read() == b"hello"
+
+
+def test_simple_tar_string_defaults_to_private_file():
+    tar = simple_tar_string("secret", "password")
+    with tarfile.open(fileobj=tar) as t:
+        info = t.getmember("password")
+        assert info.mode == 0o600
+        assert (info.uid, info.gid) == (os.getuid(), os.getgid())
+
+
+def test_files_into_container_uploads_one_tar(tmp_path):
+    local = tmp_path / "local.txt"
+    local.write_bytes(b"from disk")
+    local.chmod(0o600)
+    uploads = []
+    container = mock.Mock()
+    container.put_archive.side_effect = lambda p, f: uploads.append((p, f))
+    entries = [
+        ("server {}", "/etc/nginx/conf.d/site.conf"),
+        (b"main", "/etc/nginx/nginx.conf", 0o640),
+        (local, "/etc/nginx/certs/key/local.txt"),
+    ]
+    files_into_container(container, entries)
+    assert len(uploads) == 1
+    path, data = uploads[0]
+    assert path == "/etc/nginx"
+    with tarfile.open(fileobj=io.BytesIO(data)) as t:
+        members = {x.name: x for x in t.getmembers()}
+        # No entries for directories, which would change the mode and
+        # owner of any that already exist
+        assert list(members.keys()) == [
+            "conf.d/site.conf",
+            "nginx.conf",
+            "certs/key/local.txt",
+        ]
+        assert members["conf.d/site.conf"].mode == 0o644
+        assert members["nginx.conf"].mode == 0o640
+        assert members["certs/key/local.txt"].mode == 0o600
+        assert members["certs/key/local.txt"].uid == 0
+        assert t.extractfile("certs/key/local.txt").read() == b"from disk"
+
+
+def test_files_into_container_requires_absolute_paths():
+    container = mock.Mock()
+    with pytest.raises(Exception, match="'a/b' is not an absolute path"):
+        files_into_container(container, [("x", "a/b")])
+    files_into_container(container, [])
+    container.put_archive.assert_not_called()
+
+
+def test_files_into_container_creates_directories():
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    entries = [("a", "/data/x/a.txt"), ("b", "/data/y/z/b.txt", 0o600)]
+    container.exec_run(["mkdir", "/data"])
+    files_into_container(container, entries, uid=100)
+    assert string_from_container(container, "/data/x/a.txt") == "a"
+    assert string_from_container(container, "/data/y/z/b.txt") == "b"
+    out = container.exec_run(["stat", "-c", "%a %u", "/data/y/z/b.txt"])
+    assert out.output.decode("UTF-8").strip() == "600 100"
+    container.kill()
+
+
+def test_files_into_container_leaves_existing_directories():
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    entries = [("x", "/tmp/x"), ("y", "/etc/nginx/y")]
+    files_into_container(container, entries, uid=100)
+    out = container.exec_run(["stat", "-c", "%a %u", "/tmp", "/etc"])
+    assert out.output.decode("UTF-8").split("\n")[:2] == ["1777 0", "755 0"]
+    assert string_from_container(container, "/etc/nginx/y") == "y"
+    container.kill()
+
+
+def archive_chunks(files, size=7):
+    # Mimic get_archive: a tar stream, delivered in small chunks
+    f = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=f) as t:
+        for name, content in files.items():
+            if content is None:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                t.addfile(info)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                t.addfile(info, io.BytesIO(content))
+    data = f.getvalue()
+    return iter([data[i : i + size] for i in range(0, len(data), size)])
+
+
+def make_tree(path):
+    for rel in ["a.txt", "b.log", "sub/c.txt", "sub/deep/d.txt", "skip/e.txt"]:
+        p = path / rel
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(rel)
+
+
+def test_walk_filtered(tmp_path):
+    make_tree(tmp_path)
+    assert list(walk_filtered(str(tmp_path))) == [
+        "skip",
+        "sub",
+        "a.txt",
+        "b.log",
+        "skip/e.txt",
+        "sub/deep",
+        "sub/c.txt",
+        "sub/deep/d.txt",
+    ]
+    res = walk_filtered(
+        str(tmp_path), include=["*.txt"], exclude=["skip", "*/deep"]
+    )
+    assert list(res) == ["sub", "a.txt", "sub/c.txt"]
+    assert list(walk_filtered(str(tmp_path / "a.txt"))) == []
+
+
+def test_tar_stream_produces_archive_in_chunks():
+    content = bytes(range(256)) * 1000
+
+    def build(t):
+        t.addfile(tar_info("big", len(content)), io.BytesIO(content))
+
+    chunks = list(tar_stream(build, chunk_size=4096))
+    assert len(chunks) > 10
+    assert max(len(x) for x in chunks) <= tarfile.RECORDSIZE
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as t:
+        assert t.extractfile("big").read() == content
+
+
+def test_tar_stream_propagates_errors():
+    def build(_t):
+        msg = "some error"
+        raise Exception(msg)
+
+    with pytest.raises(Exception, match="some error"):
+        list(tar_stream(build))
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_tar_stream_can_compress(compression):
+    if compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+    content = b"abc" * 10000
+
+    def build(t):
+        t.addfile(tar_info("x", len(content)), io.BytesIO(content))
+
+    data = b"".join(tar_stream(build, compression=compression))
+    assert len(data) < len(content) / 10
+    # tarfile only reads zstd itself from python 3.14
+    if compression == "gzip":
+        data = gzip.decompress(data)
+    else:
+        data = zstandard.ZstdDecompressor().stream_reader(data).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as t:
+        assert t.extractfile("x").read() == content
+
+
+def test_tar_stream_rejects_unknown_compression():
+    with pytest.raises(Exception, match="Unknown compression 'lzma'"):
+        tar_stream(lambda _t: None, compression="lzma")
+
+
+def test_archive_from_container_decompresses_exec_output():
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+        with tarfile.open(mode="w", fileobj=gz) as t:
+            t.addfile(tar_info("dump", 5), io.BytesIO(b"hello"))
+    data = f.getvalue()
+    chunks = [(data[i : i + 10], None) for i in range(0, len(data), 10)]
+    api = mock.Mock()
+    api.exec_create.return_value = {"Id": "e1"}
+    api.exec_start.return_value = iter([*chunks, (None, b"warning")])
+    api.exec_inspect.return_value = {"ExitCode": 0}
+    container = mock.Mock(id="c1")
+    with using_client(mock.Mock(api=api)):
+        res = bytes_from_container(container, "/data/dump", compression="gzip")
+    assert res == b"hello"
+    container.get_archive.assert_not_called()
+    args = api.exec_create.call_args[0][1]
+    assert args[-2:] == ["/data", "dump"]
+    assert "| gzip -c" in args[2]
+
+
+def test_archive_from_container_reports_exec_failure():
+    api = mock.Mock()
+    api.exec_create.return_value = {"Id": "e1"}
+    api.exec_start.return_value = iter([(None, b"gzip: not found")])
+    api.exec_inspect.return_value = {"ExitCode": 127}
+    f = io.StringIO()
+    with using_client(mock.Mock(api=api)), redirect_stdout(f):
+        stream = archive_from_container(mock.Mock(), "/data", "gzip")
+        with pytest.raises(Exception, match="Error creating archive"):
+            stream.read()
+    assert "gzip: not found" in f.getvalue()
+
+
+def split_bytes(data, n):
+    return [data[i : i + n] for i in range(0, len(data), n)]
+
+
+def local_exec_client():
+    # Run "exec"s on this machine, to check the shell we send
+    results = {}
+
+    def exec_create(_id, args, **_kwargs):
+        results["e1"] = subprocess.run(args, capture_output=True, check=False)
+        return {"Id": "e1"}
+
+    api = mock.Mock()
+    api.exec_create.side_effect = exec_create
+    # Output arrives in chunks, as it would from docker
+    api.exec_start.side_effect = lambda eid, **_kw: iter(
+        [
+            *((x, None) for x in split_bytes(results[eid].stdout, 8)),
+            (None, results[eid].stderr or None),
+        ]
+    )
+    api.exec_inspect.side_effect = lambda eid: {
+        "ExitCode": results[eid].returncode
+    }
+    return mock.Mock(api=api)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_archive_from_container_runs_tar_and_compressor(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    make_tree(tmp_path / "data")
+    with using_client(local_exec_client()):
+        directory_from_container(
+            mock.Mock(),
+            str(tmp_path / "data"),
+            str(tmp_path / "copy"),
+            compression,
+        )
+    assert (tmp_path / "copy" / "sub" / "c.txt").read_text() == "sub/c.txt"
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_archive_from_container_reports_tar_failure(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    f = io.StringIO()
+    path = str(tmp_path / "missing")
+    with using_client(local_exec_client()), redirect_stdout(f):
+        with pytest.raises(Exception, match="Error creating archive"):
+            bytes_from_container(mock.Mock(), path, compression)
+    assert "missing" in f.getvalue()
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_directory_from_container_detects_incomplete_archive(
+    tmp_path, compression
+):
+    # tar wrote a valid archive, but failed on some file along the way
+    f = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=f) as t:
+        t.addfile(tar_info("data/a", 1), io.BytesIO(b"a"))
+    # Data after the end of the archive, which tarfile never reads
+    frames = [f.getvalue(), os.urandom(1_000_000)]
+    if compression == "gzip":
+        data = b"".join(gzip.compress(x) for x in frames)
+    else:
+        zstd = pytest.importorskip("zstandard").ZstdCompressor()
+        data = b"".join(zstd.compress(x) for x in frames)
+    chunks = [(data[i : i + 1000], None) for i in range(0, len(data), 1000)]
+    api = mock.Mock()
+    api.exec_create.return_value = {"Id": "e1"}
+    api.exec_start.return_value = iter(
+        [*chunks, (None, b"tar: data/b: Permission denied")]
+    )
+    api.exec_inspect.return_value = {"ExitCode": 2}
+    with using_client(mock.Mock(api=api)), redirect_stdout(io.StringIO()):
+        with pytest.raises(Exception, match="Error creating archive"):
+            directory_from_container(
+                mock.Mock(), "/data", str(tmp_path), compression
+            )
+
+
+def test_compressed_transfers_round_trip(tmp_path):
+    make_tree(tmp_path / "data")
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    path_into_container(tmp_path / "data", container, "/", compression="gzip")
+    res = bytes_from_container(container, "/data/a.txt", compression="gzip")
+    assert res == b"a.txt"
+    directory_from_container(
+        container, "/data", str(tmp_path / "copy"), compression="gzip"
+    )
+    container.kill()
+    assert (tmp_path / "copy" / "sub" / "deep" / "d.txt").read_text() == (
+        "sub/deep/d.txt"
+    )
+
+
+def test_path_into_container_streams_directory(tmp_path):
+    make_tree(tmp_path / "data")
+    uploads = []
+    container = mock.Mock()
+    container.put_archive.side_effect = lambda p, f: uploads.append(
+        (p, list(f))
+    )
+    path_into_container(
+        tmp_path / "data", container, "/srv", exclude=["skip"], uid=0, gid=0
+    )
+    path, chunks = uploads[0]
+    assert path == "/srv"
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as t:
+        assert t.getnames() == [
+            "data",
+            "data/sub",
+            "data/a.txt",
+            "data/b.log",
+            "data/sub/deep",
+            "data/sub/c.txt",
+            "data/sub/deep/d.txt",
+        ]
+        assert {x.uid for x in t.getmembers()} == {0}
+        assert t.extractfile("data/sub/c.txt").read() == b"sub/c.txt"
+
+
+def test_path_into_container_copies_tree(tmp_path):
+    make_tree(tmp_path / "data")
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    path_into_container(tmp_path / "data", container, "/", include=["*.txt"])
+    assert string_from_container(container, "/data/sub/deep/d.txt") == (
+        "sub/deep/d.txt"
+    )
+    res = container.exec_run(["ls", "/data"])
+    assert res.output.decode("UTF-8").split() == ["a.txt", "skip", "sub"]
+    container.kill()
+
+
+def test_stream_from_container_reads_incrementally():
+    content = bytes(range(256)) * 100
+    container = mock.Mock()
+    container.get_archive.return_value = (archive_chunks({"dump": content}), {})
+    res = list(stream_from_container(container, "/data/dump", 1000))
+    assert [len(x) for x in res[:2]] == [1000, 1000]
+    assert b"".join(res) == content
+    container.get_archive.assert_called_once_with("/data/dump")
+
+
+def test_stream_from_container_rejects_directories():
+    container = mock.Mock()
+    container.get_archive.return_value = (archive_chunks({"data": None}), {})
+    with pytest.raises(Exception, match="'/data' is not a regular file"):
+        list(stream_from_container(container, "/data"))
+
+
+def test_directory_from_container(tmp_path):
+    files = {
+        "data": None,
+        "data/a.txt": b"a",
+        "data/sub": None,
+        "data/sub/b.txt": b"b",
+    }
+    container = mock.Mock()
+    container.get_archive.return_value = (archive_chunks(files), {})
+    dest = tmp_path / "out"
+    directory_from_container(container, "/srv/data/", str(dest))
+    assert (dest / "a.txt").read_bytes() == b"a"
+    assert (dest / "sub" / "b.txt").read_bytes() == b"b"
+    assert not (dest / "data").exists()
+
+
+def test_directory_from_container_rejects_unexpected_entries(tmp_path):
+    container = mock.Mock()
+    chunks = archive_chunks({"data/a": b"a", "other/b": b"b"})
+    container.get_archive.return_value = (chunks, {})
+    with pytest.raises(Exception, match="Unexpected entry 'other/b'"):
+        directory_from_container(container, "/data", str(tmp_path))
+
+
+def test_directory_from_container_copies_tree(tmp_path):
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    directory_from_container(container, "/etc/apk", str(tmp_path))
+    container.kill()
+    assert (tmp_path / "repositories").exists()
+    assert (tmp_path / "keys").is_dir()
+
+
+def hash_exec(files):
+    # Mimic running sha256sum over `files` (path to content)
+    def exec_run(args, **_kwargs):
+        out = [f"{sha256(files[p])}  {p}\n" for p in args[1:] if p in files]
+        err = b"missing" if len(out) < len(args) - 1 else None
+        return 1 if err else 0, (bytes("".join(out), "utf-8") or None, err)
+
+    return exec_run
+
+
+def test_sha256(tmp_path):
+    path = tmp_path / "x"
+    path.write_bytes(b"abc")
+    expected = (
+        "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+    )
+    assert sha256("abc") == expected
+    assert sha256(b"abc") == expected
+    assert sha256(path) == expected
+
+
+def test_container_hashes_omits_missing_files():
+    container = mock.Mock()
+    container.exec_run.side_effect = hash_exec({"/a": "x", "/b c": "y"})
+    assert container_hashes(container, ["/a", "/b c", "/missing"]) == {
+        "/a": sha256("x"),
+        "/b c": sha256("y"),
+    }
+    container.exec_run.assert_called_once_with(
+        ["sha256sum", "/a", "/b c", "/missing"], demux=True
+    )
+    assert container_hashes(container, []) == {}
+    container.exec_run.return_value = (127, (None, b"not found"))
+    container.exec_run.side_effect = None
+    assert container_hashes(container, ["/a"]) == {}
+    # Containers that are not running yet cannot exec
+    container.exec_run.side_effect = docker.errors.APIError("not running")
+    assert container_hashes(container, ["/a"]) == {}
+    assert string_into_container("x", container, "/a", skip_unchanged=True)
+
+
+def test_string_into_container_can_skip_unchanged():
+    container = mock.Mock()
+    container.exec_run.side_effect = hash_exec({"/etc/x.conf": "same"})
+    res = string_into_container(
+        "same", container, "/etc/x.conf", skip_unchanged=True
+    )
+    assert res is False
+    container.put_archive.assert_not_called()
+    res = string_into_container(
+        "new", container, "/etc/x.conf", skip_unchanged=True
+    )
+    assert res is True
+    container.put_archive.assert_called_once()
+
+
+def test_files_into_container_uploads_only_changed(tmp_path):
+    local = tmp_path / "local"
+    local.write_text("disk")
+    container = mock.Mock()
+    container.exec_run.side_effect = hash_exec(
+        {"/etc/a": "a", "/etc/b": "old", "/etc/c": "disk"}
+    )
+    entries = [
+        ("a", "/etc/a"),
+        ("b", "/etc/b"),
+        (local, "/etc/c"),
+        ("d", "/etc/new/d"),
+    ]
+    res = files_into_container(container, entries, skip_unchanged=True)
+    assert res == ["/etc/b", "/etc/new/d"]
+    path, data = container.put_archive.call_args[0]
+    assert path == "/etc"
+    with tarfile.open(fileobj=io.BytesIO(data)) as t:
+        assert t.getnames() == ["b", "new/d"]
+
+    container.put_archive.reset_mock()
+    res = files_into_container(container, entries[:1], skip_unchanged=True)
+    assert res == []
+    container.put_archive.assert_not_called()
+
+
+def test_string_into_container_sets_mode_and_owner():
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "20"], detach=True, auto_remove=True
+    )
+    string_into_container("x", container, "/test", mode=0o640, uid=100, gid=101)
+    out = container.exec_run(["stat", "-c", "%a %u %g", "/test"])
+    assert out.output.decode("UTF-8").strip() == "640 100 101"
+    container.kill()
+
+
 def test_file_into_container():
     cl = docker.client.from_env()
     container = cl.containers.run(
@@ -197,6 +727,160 @@ def test_return_logs_and_remove_returns_stderr():
     assert "can't open './nonsense'" in result
 
 
+def test_exec_stream_yields_output():
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "10"], detach=True, auto_remove=True
+    )
+    args = ["sh", "-c", "echo out; echo err >&2"]
+    res = list(exec_stream(container, args))
+    container.kill()
+    assert ("stdout", b"out\n") in res
+    assert ("stderr", b"err\n") in res
+
+
+def test_exec_stream_reports_tail_on_failure():
+    cl = docker.client.from_env()
+    container = cl.containers.run(
+        "alpine", ["sleep", "10"], detach=True, auto_remove=True
+    )
+    args = ["sh", "-c", "seq 1000; exit 1"]
+    f = io.StringIO()
+    with redirect_stdout(f), pytest.raises(Exception, match="Error running"):
+        list(exec_stream(container, args, tail=10))
+    container.kill()
+    assert f.getvalue().strip().endswith("999\n1000")
+    assert "\n1\n" not in f.getvalue()
+
+
+def test_stream_logs_and_remove():
+    res = list(stream_logs_and_remove("alpine", ["echo", "1234"]))
+    assert res == [("stdout", b"1234\n")]
+    args = ["sh", "./nonsense"]
+    f = io.StringIO()
+    with redirect_stdout(f), pytest.raises(Exception, match="Error running"):
+        list(stream_logs_and_remove("alpine", args))
+    assert "can't open './nonsense'" in f.getvalue()
+
+
+def test_stream_logs_and_remove_pulls_missing_image():
+    container = mock.Mock(id="c1")
+    container.wait.return_value = {"StatusCode": 0}
+    client = mock.Mock()
+    client.containers.create.side_effect = [
+        docker.errors.ImageNotFound("no such image"),
+        container,
+    ]
+    client.api.attach.return_value = iter([(b"1234\n", None)])
+    with using_client(client):
+        res = list(stream_logs_and_remove("alpine", ["echo", "1234"]))
+    assert res == [("stdout", b"1234\n")]
+    client.images.pull.assert_called_once_with("alpine")
+    assert client.containers.create.call_count == 2
+    container.remove.assert_called_once_with(force=True)
+
+
+def test_stream_logs_and_remove_kills_on_timeout():
+    cl = docker.client.from_env()
+    n = len(cl.containers.list(all=True))
+    t0 = time.monotonic()
+    with pytest.raises(Exception, match="Timed out after 1 seconds"):
+        list(stream_logs_and_remove("alpine", ["sleep", "100"], timeout=1))
+    assert time.monotonic() - t0 < 20
+    assert len(cl.containers.list(all=True)) == n
+
+
+def test_exec_stream_streams_with_timeout():
+    api = mock.Mock()
+    api.exec_create.return_value = {"Id": "e1"}
+    api.exec_start.return_value = iter(
+        [(b"a", None), (None, b"b"), (b"c", b"d")]
+    )
+    api.exec_inspect.return_value = {"ExitCode": 0}
+    client = mock.Mock(api=api)
+    with using_client(client):
+        res = list(exec_stream(mock.Mock(id="c1"), ["ls"], timeout=5))
+    assert res == [
+        ("stdout", b"a"),
+        ("stderr", b"b"),
+        ("stdout", b"c"),
+        ("stderr", b"d"),
+    ]
+    api.exec_start.assert_called_once_with("e1", stream=True, demux=True)
+
+
+def test_exec_stream_times_out():
+    def chunks():
+        yield b"a", None
+        time.sleep(10)
+
+    api = mock.Mock()
+    api.exec_create.return_value = {"Id": "e1"}
+    api.exec_start.return_value = chunks()
+    client = mock.Mock(api=api)
+    res = []
+    with using_client(client), pytest.raises(Exception, match="Timed out"):
+        for x in exec_stream(mock.Mock(id="c1"), ["ls"], timeout=0.2):
+            res.append(x)
+    assert res == [("stdout", b"a")]
+    api.exec_inspect.assert_not_called()
+
+
+def mock_exec_client(outputs):
+    # outputs maps container id to (chunks, exit code)
+    api = mock.Mock()
+    api.exec_create.side_effect = lambda cid, *_args, **_kw: {"Id": cid}
+    api.exec_start.side_effect = lambda eid, **_kw: outputs[eid][0]
+    api.exec_inspect.side_effect = lambda eid: {"ExitCode": outputs[eid][1]}
+    return mock.Mock(api=api)
+
+
+def test_exec_all_reports_per_container():
+    def slow():
+        time.sleep(10)
+        yield b"never", None
+
+    containers = {x: mock.Mock(id=x) for x in ["a", "b", "c"]}
+    client = mock_exec_client(
+        {
+            "a": ([(b"ok", None)], 0),
+            "b": ([(b"x", b"failed")], 2),
+            "c": (slow(), 0),
+        }
+    )
+    with using_client(client):
+        res = exec_all(containers, ["flush"], timeout=0.5, check=False)
+    assert list(res.keys()) == ["a", "b", "c"]
+    assert res["a"].ok
+    assert res["a"].output == b"ok"
+    assert res["b"].exit_code == 2
+    assert res["b"].output == b"xfailed"
+    assert not res["b"].ok
+    assert res["c"].exit_code is None
+    assert "Timed out" in res["c"].error
+    assert res["c"].duration >= 0.5
+
+
+def test_exec_all_fails_after_all_containers_report():
+    containers = {x: mock.Mock(id=x) for x in ["a", "b", "c"]}
+    client = mock_exec_client(
+        {
+            "a": ([(None, b"oops")], 1),
+            "b": ([(b"fine", None)], 0),
+            "c": ([(None, b"bad")], 3),
+        }
+    )
+    f = io.StringIO()
+    with using_client(client), redirect_stdout(f), pytest.raises(
+        ExecError, match="Error running command in 2 of 3 containers: a, c"
+    ) as e:
+        exec_all(containers, ["flush"], parallel=1)
+    assert client.api.exec_inspect.call_count == 3
+    assert [x.exit_code for x in e.value.reports.values()] == [1, 0, 3]
+    assert "'a' failed (exit code 1):\noops" in f.getvalue()
+    assert "'c' failed (exit code 3):\nbad" in f.getvalue()
+
+
 def test_ensure_network_creates_network():
     cl = docker.client.from_env()
     nm = "constellation_example_nw"
@@ -306,3 +990,275 @@ def test_container_remove_wait():
     container.kill()
     container_remove_wait(container, timeout=10)
     assert not container_exists(container.name)
+
+
+def test_container_stop_respects_deadline(capsys):
+    container = mock.Mock(status="running")
+    container_stop(container, False, "a", timeout=30, until=None)
+    container.stop.assert_called_once_with(timeout=30)
+
+    container = mock.Mock(status="running")
+    until = time.monotonic() + 5.5
+    container_stop(container, False, "b", timeout=30, until=until)
+    container.stop.assert_called_once_with(timeout=5)
+
+    container = mock.Mock(status="running")
+    until = time.monotonic() - 1
+    container_stop(container, False, "c", timeout=30, until=until)
+    container.kill.assert_called_once_with()
+    container.stop.assert_not_called()
+
+    assert capsys.readouterr().out == "Stop 'a'\nStop 'b'\nKilling 'c'\n"
+
+
+def test_container_stop_keeps_default_timeout_within_deadline():
+    # A deadline only shortens docker's default timeout
+    container = mock.Mock(status="running")
+    until = time.monotonic() + 300
+    container_stop(container, False, "a", until=until)
+    container.stop.assert_called_once_with(timeout=None)
+
+    container = mock.Mock(status="running")
+    until = time.monotonic() + 5.5
+    container_stop(container, False, "b", until=until)
+    container.stop.assert_called_once_with(timeout=5)
+
+
+def test_client_is_shared_and_can_be_overridden():
+    default = get_client()
+    assert get_client() is default
+    other = object()
+    try:
+        with using_client(other):
+            assert get_client() is other
+            assert (
+                run_parallel(lambda _: get_client(), range(4), 4) == [other] * 4
+            )
+        assert get_client() is default
+        set_default_client(other)
+        assert get_client() is other
+    finally:
+        set_default_client(default)
+
+
+def test_containers_wait_running_waits_for_many_at_once():
+    cl = docker.client.from_env()
+    containers = [
+        cl.containers.run("alpine", ["sleep", "100"], detach=True)
+        for _ in range(3)
+    ]
+    t0 = time.monotonic()
+    res = containers_wait_running(containers, 1.5)
+    assert time.monotonic() - t0 < 3
+    assert res == containers
+    for x in containers:
+        x.kill()
+        x.remove()
+
+
+def test_containers_wait_running_returns_when_healthy():
+    cl = docker.client.from_env()
+    healthcheck = {"test": ["CMD", "true"], "interval": 100_000_000}
+    container = cl.containers.run(
+        "alpine", ["sleep", "100"], detach=True, healthcheck=healthcheck
+    )
+    t0 = time.monotonic()
+    containers_wait_running([container], 30)
+    assert time.monotonic() - t0 < 10
+    container.kill()
+    container.remove()
+
+
+def test_containers_wait_running_detects_unhealthy():
+    cl = docker.client.from_env()
+    healthcheck = {
+        "test": ["CMD", "false"],
+        "interval": 100_000_000,
+        "retries": 1,
+    }
+    container = cl.containers.run(
+        "alpine", ["sleep", "100"], detach=True, healthcheck=healthcheck
+    )
+    with pytest.raises(Exception, match="is unhealthy"):
+        containers_wait_running([container], 30)
+    container.kill()
+    container.remove()
+
+
+def test_containers_wait_running_uses_events():
+    x = mock.Mock(id="abc123", status="running")
+    x.name = "x"
+    x.attrs = {"State": {"Health": {"Status": "starting"}}}
+    x.health = "starting"
+    client = mock.Mock()
+    client.events.return_value = mock.MagicMock()
+    client.events.return_value.__iter__.return_value = iter(
+        [{"id": "abc123", "Action": "health_status: healthy"}]
+    )
+    with using_client(client):
+        t0 = time.monotonic()
+        assert containers_wait_running([x], 30) == [x]
+        assert time.monotonic() - t0 < 1
+    client.events.return_value.close.assert_called_once_with()
+
+
+def test_containers_wait_healthy_sees_health_from_events():
+    # The daemon's view of the container, which reload() reads
+    state = {"health": "starting"}
+
+    def reload():
+        x.health = state["health"]
+
+    def events():
+        state["health"] = "healthy"
+        yield {"id": "abc123", "Action": "health_status: healthy"}
+
+    x = mock.Mock(id="abc123", status="running")
+    x.name = "x"
+    x.attrs = {"State": {"Health": {"Status": "starting"}}}
+    x.reload.side_effect = reload
+    client = mock.Mock()
+    client.events.return_value = mock.MagicMock()
+    client.events.return_value.__iter__.return_value = events()
+    with using_client(client):
+        assert containers_wait_healthy([x], 30) == [x]
+    assert x.health == "healthy"
+
+
+def make_context(path):
+    (path / "sub").mkdir(parents=True)
+    (path / "Dockerfile").write_text("FROM alpine\nCOPY . /src\n")
+    (path / "a.txt").write_text("a")
+    (path / "sub" / "b.txt").write_text("b")
+    (path / "build.log").write_text("log")
+    (path / ".dockerignore").write_text("# comment\n*.log\n")
+
+
+def test_build_fingerprint_follows_context(tmp_path):
+    make_context(tmp_path)
+    spec = BuildSpec(str(tmp_path))
+    fp = build_fingerprint(spec)
+    # Ignored files and modification times do not matter
+    (tmp_path / "build.log").write_text("more log")
+    (tmp_path / "other.log").write_text("new log")
+    os.utime(tmp_path / "a.txt", (0, 0))
+    assert build_fingerprint(spec) == fp
+    # Content, new files and modes do
+    (tmp_path / "sub" / "b.txt").write_text("B")
+    fp2 = build_fingerprint(spec)
+    assert fp2 != fp
+    (tmp_path / "sub" / "c.txt").write_text("c")
+    fp3 = build_fingerprint(spec)
+    assert fp3 not in {fp, fp2}
+    (tmp_path / "a.txt").chmod(0o755)
+    assert build_fingerprint(spec) not in {fp, fp2, fp3}
+
+
+def test_build_fingerprint_does_not_depend_on_location(tmp_path):
+    make_context(tmp_path / "x")
+    make_context(tmp_path / "y")
+    assert build_fingerprint(BuildSpec(str(tmp_path / "x"))) == (
+        build_fingerprint(BuildSpec(str(tmp_path / "y")))
+    )
+
+
+def test_image_build_skips_unchanged_context(tmp_path):
+    make_context(tmp_path)
+    spec = BuildSpec(str(tmp_path))
+    fp = build_fingerprint(spec)
+    client = mock.Mock()
+    client.images.list.return_value = [mock.Mock(id="sha256:abc")]
+    f = io.StringIO()
+    with using_client(client), redirect_stdout(f):
+        assert image_build("x", spec) == "sha256:abc"
+    client.images.list.assert_called_once_with(
+        filters={"label": [f"constellation.build={fp}"]}
+    )
+    client.images.build.assert_not_called()
+    assert "context unchanged" in f.getvalue()
+
+    client.images.list.return_value = []
+    client.api.build.return_value = iter(
+        [{"stream": "Step 1/2\nStep 2/2\n"}, {"aux": {"ID": "sha256:def"}}]
+    )
+    with using_client(client), redirect_stdout(f):
+        assert image_build("x", spec) == "sha256:def"
+    client.api.build.assert_called_once_with(
+        path=str(tmp_path),
+        dockerfile=None,
+        buildargs=None,
+        target=None,
+        cache_from=None,
+        labels={"constellation.build": fp},
+        rm=True,
+        decode=True,
+    )
+
+
+def test_image_build_passes_options_and_streams_log(tmp_path):
+    make_context(tmp_path)
+    spec = BuildSpec(
+        str(tmp_path),
+        dockerfile="Dockerfile",
+        buildargs={"VERSION": "1"},
+        target="prod",
+        cache_from=["example/app:latest"],
+        labels={"app": "x"},
+    )
+    client = mock.Mock()
+    client.images.list.return_value = []
+    client.api.build.return_value = iter(
+        [
+            {"stream": "Step 1/2 : FROM alpine\n"},
+            {"stream": " ---> abc\n"},
+            {"aux": {"ID": "sha256:def"}},
+            {"stream": "Successfully built def\n"},
+        ]
+    )
+    lines = []
+    with using_client(client), redirect_stdout(io.StringIO()):
+        res = image_build("x", spec, lambda *x: lines.append(x))
+    assert res == "sha256:def"
+    assert lines == [
+        ("x", "Step 1/2 : FROM alpine"),
+        ("x", " ---> abc"),
+        ("x", "Successfully built def"),
+    ]
+    kwargs = client.api.build.call_args[1]
+    assert kwargs["dockerfile"] == "Dockerfile"
+    assert kwargs["buildargs"] == {"VERSION": "1"}
+    assert kwargs["target"] == "prod"
+    assert kwargs["cache_from"] == ["example/app:latest"]
+    assert kwargs["labels"] == {
+        "app": "x",
+        "constellation.build": build_fingerprint(spec),
+    }
+
+
+def test_image_build_reports_errors(tmp_path):
+    make_context(tmp_path)
+    client = mock.Mock()
+    client.images.list.return_value = []
+    client.api.build.return_value = iter(
+        [{"stream": "Step 1/2\n"}, {"error": "no such file\n"}]
+    )
+    with using_client(client), redirect_stdout(io.StringIO()), pytest.raises(
+        Exception, match=r"Error building image for x: no such file$"
+    ):
+        image_build("x", BuildSpec(str(tmp_path)))
+
+
+def test_build_fingerprint_includes_options(tmp_path):
+    make_context(tmp_path)
+    fp = build_fingerprint(BuildSpec(str(tmp_path)))
+    other = build_fingerprint(BuildSpec(str(tmp_path), target="dev"))
+    assert fp != other
+    args = build_fingerprint(BuildSpec(str(tmp_path), buildargs={"A": "1"}))
+    assert args not in {fp, other}
+    # A Dockerfile from outside the context is part of the build
+    outside = tmp_path.parent / "Other.dockerfile"
+    outside.write_text("FROM alpine\n")
+    spec = BuildSpec(str(tmp_path), dockerfile=str(outside))
+    fp1 = build_fingerprint(spec)
+    outside.write_text("FROM debian\n")
+    assert build_fingerprint(spec) != fp1
@@ -0,0 +1,140 @@
+from unittest import mock
+
+import docker
+
+from constellation import docker_util
+from constellation.constellation import ConstellationService
+from constellation.inventory import Inventory
+
+
+def mock_client(containers=(), networks=(), volumes=()):
+    client = mock.MagicMock()
+    client.api.containers.return_value = [
+        {
+            "Id": f"id-{name}",
+            "Names": [f"/{name}"],
+            "State": state,
+            "Labels": {
+                "constellation.prefix": "p",
+                "constellation.role": role,
+            },
+        }
+        for name, role, state in containers
+    ]
+    client.api.networks.return_value = [{"Name": x} for x in networks]
+    client.api.volumes.return_value = {
+        "Volumes": [{"Name": x} for x in volumes]
+    }
+    client.containers.prepare_model.side_effect = lambda attrs: (
+        docker.models.containers.Container(attrs=attrs)
+    )
+    return client
+
+
+def test_inventory_answers_from_one_snapshot():
+    client = mock_client(
+        [
+            ("p-server", "server", "running"),
+            ("p-worker-1", "worker", "running"),
+            ("p-worker-2", "worker", "exited"),
+            ("p-worker-admin", "worker-admin", "running"),
+        ],
+        ["nw"],
+        ["vol1"],
+    )
+    with docker_util.using_client(client):
+        inv = Inventory("p", ["nw"], ["vol1", "vol2"])
+        assert inv.network_exists("nw")
+        assert inv.volume_exists("vol1")
+        assert not inv.volume_exists("vol2")
+        assert inv.container_exists("p-server")
+        assert not inv.container_exists("p-client")
+        assert inv.container_status("p-worker-2") == "exited"
+        assert inv.container_status("p-client") == "missing"
+        assert inv.get_container("p-client") is None
+
+        x = inv.get_container("p-server")
+        assert x.name == "p-server"
+        assert x.id == "id-p-server"
+        assert x.status == "running"
+        assert x.labels["constellation.role"] == "server"
+
+        labels = {"constellation.prefix": "p", "constellation.role": "worker"}
+        running = inv.containers_labelled(labels)
+        assert [x.name for x in running] == ["p-worker-1"]
+        every = inv.containers_labelled(labels, True)
+        assert [x.name for x in every] == ["p-worker-1", "p-worker-2"]
+
+    client.api.containers.assert_called_once_with(
+        all=True, filters={"label": "constellation.prefix=p"}
+    )
+    assert client.api.networks.call_count == 1
+    assert client.api.volumes.call_count == 1
+    client.api.volumes.assert_called_once_with(
+        filters={"name": ["vol1", "vol2"]}
+    )
+
+
+def test_inventory_refreshes_after_changes():
+    client = mock_client([("p-server", "server", "running")])
+    with docker_util.using_client(client):
+        inv = Inventory("p")
+        assert inv.container_exists("p-server")
+        assert inv.container_exists("p-server")
+        assert client.api.containers.call_count == 1
+        docker_util.mark_changed()
+        assert inv.container_exists("p-server")
+        assert client.api.containers.call_count == 2
+    client.api.networks.assert_not_called()
+    client.api.volumes.assert_not_called()
+
+
+def test_inventory_finds_unlabelled_containers_by_name():
+    # Containers created before constellation labelled them
+    labelled = [{"Id": "id-1", "Names": ["/p-a"], "State": "running"}]
+    unlabelled = [
+        {"Id": "id-2", "Names": ["/p-server"], "State": "running"},
+        {"Id": "id-3", "Names": ["/p-server-old"], "State": "exited"},
+    ]
+    client = mock.MagicMock()
+    client.api.containers.side_effect = [labelled, unlabelled]
+    with docker_util.using_client(client):
+        inv = Inventory("p", containers=["p-server"])
+        assert inv.container_exists("p-a")
+        assert inv.container_exists("p-server")
+        assert inv.container_status("p-server") == "running"
+        assert not inv.container_exists("p-server-old")
+    assert client.api.containers.call_args_list == [
+        mock.call(all=True, filters={"label": "constellation.prefix=p"}),
+        mock.call(all=True, filters={"name": ["^/p\\-server$"]}),
+    ]
+
+
+def test_service_finds_unlabelled_replicas_by_name():
+    # Replicas created before constellation labelled them had random
+    # names; labelled containers are only taken from their labels.
+    labels = {"constellation.prefix": "p", "constellation.role": "worker"}
+    labelled = [
+        {"Id": "id-1", "Names": ["/p-worker-1"], "State": "running"},
+        {"Id": "id-2", "Names": ["/p-worker-admin-1"], "State": "running"},
+    ]
+    labelled[0]["Labels"] = {**labels, "constellation.replica": "1"}
+    labelled[1]["Labels"] = {**labels, "constellation.role": "worker-admin"}
+    unlabelled = [
+        {"Id": "id-3", "Names": ["/p-worker-abcdefgh"], "State": "running"},
+        {"Id": "id-4", "Names": ["/p-worker-ijklmnop"], "State": "exited"},
+    ]
+    client = mock_client()
+    client.api.containers.side_effect = [labelled, unlabelled]
+    svc = ConstellationService("worker", "library/alpine:latest", 2)
+    with docker_util.using_client(client):
+        inv = Inventory("p", replicas=[svc.replica_prefix("p")])
+        assert [x.name for x in svc.get("p", inventory=inv)] == [
+            "p-worker-1",
+            "p-worker-abcdefgh",
+        ]
+        assert len(svc.get("p", True, inv)) == 3
+        assert svc.exists("p", inv)
+    assert client.api.containers.call_args_list[1] == mock.call(
+        all=True, filters={"name": ["^/p\\-worker\\-"]}
+    )
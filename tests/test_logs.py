@@ -0,0 +1,55 @@
+import threading
+from unittest import mock
+
+from constellation.logs import LogFollower, LogLine, parse_line, split_lines
+
+
+def test_split_lines_reassembles_partial_lines():
+    chunks = [b"a\nb", b"c\n", b"d", b"e\nf"]
+    assert list(split_lines(chunks)) == [b"a", b"bc", b"de", b"f"]
+    assert list(split_lines([])) == []
+
+
+def test_parse_line():
+    line = parse_line("x", b"2024-01-02T03:04:05.123456789Z hello world\r")
+    assert line == LogLine("x", "2024-01-02T03:04:05.123456789Z", "hello world")
+    assert str(line) == "x | 2024-01-02T03:04:05.123456789Z hello world"
+
+
+def mock_container(lines):
+    container = mock.Mock()
+    container.logs.return_value = iter(
+        [f"2024-01-01T00:00:0{i}Z {x}\n".encode() for i, x in enumerate(lines)]
+    )
+    return container
+
+
+def test_log_follower_reads_all_containers():
+    containers = {
+        "a": mock_container(["a1", "a2"]),
+        "b": mock_container(["b1", "b2", "b3"]),
+    }
+    res = list(LogFollower(containers, follow=False, since=10))
+    assert sorted(x.text for x in res) == ["a1", "a2", "b1", "b2", "b3"]
+    assert [x.text for x in res if x.name == "b"] == ["b1", "b2", "b3"]
+    containers["a"].logs.assert_called_once_with(
+        stream=True, follow=False, timestamps=True, since=10
+    )
+
+
+def test_log_follower_applies_backpressure():
+    produced = []
+
+    def chunks():
+        for i in range(100):
+            produced.append(i)
+            yield f"t {i}\n".encode()
+
+    container = mock.Mock()
+    container.logs.return_value = chunks()
+    lines = LogFollower({"a": container}, queue_size=5).lines()
+    assert next(lines).text == "0"
+    # Give the reader thread a chance to run ahead
+    threading.Event().wait(0.2)
+    assert len(produced) < 10
+    lines.close()
@@ -0,0 +1,62 @@
+import socket
+from unittest import mock
+
+import pytest
+
+from constellation.ready import ExecProbe, TcpProbe, wait_ready
+
+
+def mock_container(status="running"):
+    container = mock.Mock(status=status)
+    container.name = "x"
+    container.attrs = {
+        "State": {},
+        "NetworkSettings": {"Networks": {"nw": {"IPAddress": "127.0.0.1"}}},
+    }
+    return container
+
+
+def test_tcp_probe():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        s.listen()
+        port = s.getsockname()[1]
+        assert TcpProbe(port)(None, "127.0.0.1")
+        assert TcpProbe(port, host="127.0.0.1")(None, "no.such.host.invalid")
+    assert not TcpProbe(port)(None, "127.0.0.1")
+
+
+def test_exec_probe():
+    container = mock.Mock()
+    container.exec_run.return_value = mock.Mock(exit_code=0)
+    assert ExecProbe(["true"])(container, None)
+    container.exec_run.assert_called_once_with(["true"])
+    container.exec_run.return_value = mock.Mock(exit_code=1)
+    assert not ExecProbe(["true"])(container, None)
+
+
+def test_wait_ready_retries_probe():
+    probe = mock.Mock(side_effect=[False, False, True])
+    container = mock_container()
+    wait_ready(container, probe, "nw", 10, poll=0.01)
+    assert probe.call_count == 3
+    probe.assert_called_with(container, "127.0.0.1")
+
+
+def test_wait_ready_times_out():
+    probe = mock.Mock(return_value=False)
+    with pytest.raises(Exception, match="'x' was not ready in time"):
+        wait_ready(mock_container(), probe, "nw", 0.05, poll=0.01)
+
+
+def test_wait_ready_fails_if_container_stops():
+    probe = mock.Mock(return_value=False)
+    with pytest.raises(Exception, match=r"'x' stopped \(exited\)"):
+        wait_ready(mock_container("exited"), probe, "nw", 10, poll=0.01)
+    probe.assert_not_called()
+
+
+def test_wait_ready_without_probe_or_healthcheck_returns():
+    container = mock_container()
+    wait_ready(container, None, "nw", 10)
+    container.reload.assert_called_once_with()
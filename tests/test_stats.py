@@ -0,0 +1,146 @@
+from unittest import mock
+
+import docker
+import pytest
+
+from constellation.stats import (
+    StatsCollector,
+    cpu_percent,
+    memory_percent,
+    memory_usage,
+    percentile,
+    sample_metrics,
+    summarise,
+)
+
+
+def sample(total, precpu_total, system, presystem, ncpu=2):
+    return {
+        "cpu_stats": {
+            "cpu_usage": {"total_usage": total},
+            "system_cpu_usage": system,
+            "online_cpus": ncpu,
+        },
+        "precpu_stats": {
+            "cpu_usage": {"total_usage": precpu_total},
+            "system_cpu_usage": presystem,
+        },
+        "memory_stats": {
+            "usage": 300,
+            "limit": 1000,
+            "stats": {"inactive_file": 100},
+        },
+    }
+
+
+def test_cpu_percent():
+    assert cpu_percent(sample(150, 100, 1200, 1000)) == pytest.approx(50)
+    assert cpu_percent(sample(150, 100, 1200, 1000, 4)) == pytest.approx(100)
+    # First sample from a stream has no previous sample
+    assert cpu_percent(sample(150, 0, 1000, 0)) == pytest.approx(30)
+    assert cpu_percent(sample(150, 100, 1000, 1000)) == 0
+
+
+def test_memory():
+    s = sample(0, 0, 0, 0)
+    assert memory_usage(s) == 200
+    assert memory_percent(s) == pytest.approx(20)
+    assert memory_usage({}) == 0
+    assert memory_percent({}) == 0
+
+
+def test_percentile():
+    xs = list(range(1, 101))
+    assert percentile(xs, 50) == 50
+    assert percentile(xs, 95) == 95
+    assert percentile(xs, 100) == 100
+    assert percentile([3], 50) == 3
+
+
+def test_sample_metrics():
+    s = sample(150, 100, 1200, 1000)
+    s["networks"] = {
+        "eth0": {"rx_bytes": 10, "tx_bytes": 20},
+        "eth1": {"rx_bytes": 1, "tx_bytes": 2},
+    }
+    s["blkio_stats"] = {
+        "io_service_bytes_recursive": [
+            {"op": "read", "value": 100},
+            {"op": "write", "value": 200},
+            {"op": "Read", "value": 1},
+        ]
+    }
+    assert sample_metrics(s, now=5) == {
+        "time": 5,
+        "cpu": pytest.approx(50),
+        "memory": 200,
+        "net_rx": 11,
+        "net_tx": 22,
+        "block_read": 101,
+        "block_write": 200,
+    }
+
+
+def test_summarise_reports_rates_for_counters():
+    history = [
+        {
+            "time": t,
+            "cpu": t * 10,
+            "memory": 100,
+            "net_rx": t * 1000,
+            "net_tx": 0,
+            "block_read": 0,
+            "block_write": t * t,
+        }
+        for t in range(5)
+    ]
+    res = summarise(history)
+    assert res["cpu"] == {"p50": 20, "p95": 40, "max": 40}
+    assert res["memory"] == {"p50": 100, "p95": 100, "max": 100}
+    assert res["net_rx"] == {"p50": 1000, "p95": 1000, "max": 1000}
+    assert res["block_write"] == {"p50": 3, "p95": 7, "max": 7}
+    assert summarise([]) == {}
+
+
+def test_stats_collector_keeps_bounded_history():
+    containers = {}
+    for name in ["a", "b"]:
+        x = mock.Mock()
+        x.stats.return_value = iter([sample(i, 0, 1000, 0) for i in range(10)])
+        containers[name] = x
+    collector = StatsCollector(containers, history=3)
+    collector.start()
+    for t in collector._threads:
+        t.join(5)
+    assert len(collector.history["a"]) == 3
+    assert len(collector.history["b"]) == 3
+    res = collector.summary()
+    assert res["a"]["cpu"]["max"] == pytest.approx(1.8)
+    assert res["a"]["memory"]["max"] == 200
+
+
+def test_stats_collector_stream():
+    x = mock.Mock()
+    x.stats.return_value = iter([sample(i, 0, 1000, 0) for i in range(10)])
+    stream = StatsCollector({"a": x}).stream()
+    name, metrics = next(stream)
+    assert name == "a"
+    assert metrics["memory"] == 200
+    stream.close()
+
+
+def test_stats_collector_stream_ends_with_containers():
+    containers = {}
+    for name in ["a", "b"]:
+        x = mock.Mock()
+        x.stats.return_value = iter([sample(i, 0, 1000, 0) for i in range(3)])
+        containers[name] = x
+    x = mock.Mock()
+    x.stats.side_effect = docker.errors.NotFound("gone")
+    containers["c"] = x
+    res = list(StatsCollector(containers).stream())
+    assert sorted(name for name, _ in res) == ["a", "a", "a", "b", "b", "b"]
+
+
+def test_stats_collector_stream_with_no_containers():
+    assert list(StatsCollector({}).stream()) == []
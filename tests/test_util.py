@@ -1,4 +1,26 @@
-from constellation.util import ImageReference, tabulate
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from constellation.util import (
+    ImageReference,
+    TailBuffer,
+    dependency_waves,
+    run_graph,
+    run_parallel,
+    spec_hash,
+    tabulate,
+)
+
+
+def node(name, depends_on=None):
+    return SimpleNamespace(name=name, depends_on=depends_on or [])
+
+
+def wave_names(waves):
+    return [[x.name for x in w] for w in waves]
 
 
 def test_image_reference_can_convert_to_string():
@@ -11,3 +33,116 @@ def test_tabulate():
     assert tabulate(["a"]) == {"a": 1}
     assert tabulate(["a", "a", "b"]) == {"a": 2, "b": 1}
     assert tabulate(["a", "a", "b", "a"]) == {"a": 3, "b": 1}
+
+
+def test_dependency_waves():
+    assert dependency_waves([]) == []
+    assert wave_names(dependency_waves([node("a"), node("b")])) == [["a", "b"]]
+    nodes = [
+        node("proxy", ["web", "api"]),
+        node("web", ["db"]),
+        node("api", ["db"]),
+        node("db"),
+    ]
+    assert wave_names(dependency_waves(nodes)) == [
+        ["db"],
+        ["web", "api"],
+        ["proxy"],
+    ]
+
+
+def test_dependency_waves_ignores_dependencies_outside_subset():
+    nodes = [node("web", ["db"]), node("proxy", ["web"])]
+    assert wave_names(dependency_waves(nodes)) == [["web"], ["proxy"]]
+
+
+def test_dependency_waves_detects_cycles():
+    nodes = [node("a", ["b"]), node("b", ["a"]), node("c")]
+    with pytest.raises(Exception, match="Dependency cycle between: a, b"):
+        dependency_waves(nodes)
+
+
+def test_run_parallel_preserves_order():
+    assert run_parallel(lambda x: x * 2, [1, 2, 3]) == [2, 4, 6]
+    assert run_parallel(lambda x: x * 2, [1, 2, 3], 3) == [2, 4, 6]
+
+
+def test_run_parallel_runs_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    assert run_parallel(lambda _: barrier.wait() >= 0, range(3), 3) == [
+        True,
+        True,
+        True,
+    ]
+
+
+def test_run_parallel_finishes_all_before_raising():
+    seen = []
+
+    def f(x):
+        if x == 1:
+            msg = "some error"
+            raise Exception(msg)
+        seen.append(x)
+
+    with pytest.raises(Exception, match="some error"):
+        run_parallel(f, [0, 1, 2, 3], 2)
+    assert sorted(seen) == [0, 2, 3]
+
+
+def test_run_graph_runs_serially_in_wave_order():
+    seen = []
+    nodes = [node("web", ["db"]), node("db"), node("cache")]
+    run_graph(lambda x: seen.append(x.name), nodes)
+    assert seen == ["db", "cache", "web"]
+
+
+def test_run_graph_starts_nodes_once_their_dependencies_finish():
+    seen = []
+    slow = threading.Event()
+
+    def f(x):
+        if x.name == "slow":
+            slow.wait(5)
+        seen.append(x.name)
+        if x.name == "web":
+            slow.set()
+
+    nodes = [node("slow"), node("db"), node("web", ["db"])]
+    run_graph(f, nodes, 3)
+    assert seen == ["db", "web", "slow"]
+
+
+def test_run_graph_stops_scheduling_after_error():
+    seen = []
+
+    def f(x):
+        if x.name == "db":
+            time.sleep(0.1)
+            msg = "db failed"
+            raise Exception(msg)
+        seen.append(x.name)
+
+    nodes = [node("db"), node("other"), node("web", ["db"])]
+    with pytest.raises(Exception, match="db failed"):
+        run_graph(f, nodes, 2)
+    assert seen == ["other"]
+
+
+def test_spec_hash_is_stable():
+    a = {"image": "sha256:abc", "args": ["a", "b"], "environment": {"X": 1}}
+    b = {"environment": {"X": 1}, "args": ["a", "b"], "image": "sha256:abc"}
+    assert spec_hash(a) == spec_hash(b)
+    assert spec_hash(a) != spec_hash({**a, "args": ["a"]})
+    assert len(spec_hash(a)) == 64
+
+
+def test_tail_buffer_keeps_last_bytes():
+    buf = TailBuffer(5)
+    for x in [b"abc", b"def", b"ghi", b""]:
+        buf.append(x)
+    assert buf.getvalue() == b"efghi"
+    assert len(buf._chunks) == 2
+    empty = TailBuffer(None)
+    empty.append(b"abc")
+    assert empty.getvalue() == b""